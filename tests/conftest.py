@@ -3,6 +3,8 @@ import pytest
 from udata import settings
 from udata.app import create_app
 
+from udata_metrics import client
+
 
 class MetricsSettings(settings.Testing):
     PLUGINS = ['metrics']
@@ -13,3 +15,11 @@ class MetricsSettings(settings.Testing):
 def app():
     app = create_app(settings.Defaults, override=MetricsSettings)
     return app
+
+
+@pytest.fixture(autouse=True)
+def metrics_api_breaker():
+    '''Start each test with a closed metrics API circuit'''
+    client.breaker.success()
+    yield client.breaker
+    client.breaker.success()
@@ -35,6 +35,19 @@ def mock_metrics_api(app, rmock, endpoint, value_keys, values, page_size: int =
                 }
             })
 
+def mock_metrics_csv(app, rmock, endpoint, value_keys, values):
+    for i, value in enumerate(values):
+        value['__id'] = i
+    columns = list(values[0].keys())
+    lines = [','.join(columns)] + [
+        ','.join('' if value[column] is None else str(value[column]) for column in columns)
+        for value in values
+    ]
+
+    for value_key in value_keys:
+        url = f'{app.config["METRICS_API"]}/{endpoint}_total/data/csv/?{value_key}__greater=1'
+        rmock.get(url, text='\r\n'.join(lines) + '\r\n')
+
 def mock_monthly_metrics_payload(app, rmock, target, data, target_id='id', url=None):
     if not url:
         url = f'{app.config["METRICS_API"]}/{target}s/data/' + \
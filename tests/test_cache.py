@@ -0,0 +1,112 @@
+import threading
+import time
+
+import pytest
+
+from udata.app import cache
+
+from udata_metrics.cache import cached_metrics
+from udata_metrics.executor import GatheredMetrics
+
+
+@pytest.fixture
+def simple_cache(app):
+    cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+
+
+@pytest.fixture
+def counter():
+    calls = []
+
+    @cached_metrics
+    def count_metrics(id):
+        calls.append(id)
+        return len(calls)
+
+    return count_metrics, calls
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.mark.usefixtures('simple_cache')
+class CachedMetricsTest:
+    def test_fresh_entry_is_cached(self, app, counter):
+        count_metrics, calls = counter
+
+        assert count_metrics('id') == 1
+        assert count_metrics('id') == 1
+        assert count_metrics('other') == 2
+        assert calls == ['id', 'other']
+
+    def test_stale_entry_is_served_while_refreshed(self, app, counter):
+        app.config['METRICS_CACHE_SOFT_TTL'] = 0
+        count_metrics, calls = counter
+
+        assert count_metrics('id') == 1
+        assert count_metrics('id') == 1  # Stale, refreshed in background
+        assert wait_for(lambda: cache.get(count_metrics.cache_key('id'))[1] == 2)
+        assert wait_for(lambda: count_metrics.acquire('id'))  # Lock released
+
+    def test_missing_entry_computed_by_another_worker(self, app, counter):
+        count_metrics, calls = counter
+        assert count_metrics.acquire('id')
+
+        def store():
+            with app.app_context():
+                count_metrics.store(42, 'id')
+
+        threading.Timer(0.2, store).start()
+
+        assert count_metrics('id') == 42
+        assert calls == []
+
+    def test_missing_entry_computed_after_wait(self, app, counter):
+        app.config['METRICS_CACHE_WAIT'] = 0.2
+        count_metrics, calls = counter
+        assert count_metrics.acquire('id')
+
+        assert count_metrics('id') == 1
+
+    def test_lookup_entry_version(self, app, counter):
+        count_metrics, calls = counter
+
+        version, value = count_metrics.lookup('id')
+        assert count_metrics.lookup('id') == (version, value)
+
+        assert count_metrics.acquire('id')
+        count_metrics.refresh('id')
+        assert count_metrics.lookup('id')[0] > version
+
+    def test_lookup_entry_computed_without_store(self, app, counter):
+        app.config['METRICS_CACHE_WAIT'] = 0
+        count_metrics, calls = counter
+        assert count_metrics.acquire('id')
+
+        assert count_metrics.lookup('id') == (None, 1)
+
+    def test_degraded_entry_is_fresh_shortly(self, app):
+        app.config['METRICS_CACHE_DEGRADED_TTL'] = 60
+
+        @cached_metrics
+        def degraded_metrics(id):
+            metrics = GatheredMetrics(visit={})
+            metrics.degraded = True
+            return metrics
+
+        fresh_until, _ = degraded_metrics.lookup('id')
+        assert fresh_until < time.time() + 61
+
+    def test_live_stock_entry_freshness(self, app, counter):
+        app.config['METRICS_CACHE_LIVE_STOCK_TTL'] = 60
+        count_metrics, calls = counter
+
+        assert count_metrics.lookup('live')[0] < time.time() + 61
+        app.config['METRICS_STOCK_ROLLUPS'] = True
+        assert count_metrics.lookup('rollups')[0] > time.time() + 3600
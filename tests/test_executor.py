@@ -0,0 +1,76 @@
+import time
+
+from udata_metrics.executor import GatheredMetrics, gather_metrics
+
+
+def sleeping(seconds, metrics):
+    def compute():
+        time.sleep(seconds)
+        return metrics
+    return list(metrics), compute
+
+
+def test_gather_metrics_concurrently(app):
+    start = time.time()
+    res = gather_metrics(sleeping(0.3, {'visit': {'2024-01': 1}}),
+                         sleeping(0.3, {'followers_metrics': {'2024-01': 2}}))
+
+    assert time.time() - start < 0.5
+    assert res == {'visit': {'2024-01': 1}, 'followers_metrics': {'2024-01': 2}}
+
+
+def test_gather_metrics_deadline(app):
+    app.config['METRICS_COMPUTE_DEADLINE'] = 0.1
+
+    res = gather_metrics(sleeping(0, {'visit': {'2024-01': 1}}),
+                         sleeping(0.5, {'reuses_metrics': {'2024-01': 2}}))
+
+    assert res == {'visit': {'2024-01': 1}, 'reuses_metrics': {}}
+
+
+def test_gather_metrics_error(app):
+    def fail():
+        raise ValueError('Aggregation failed')
+
+    res = gather_metrics(sleeping(0, {'visit': {'2024-01': 1}}), (['reuses_metrics'], fail))
+
+    assert res == {'visit': {'2024-01': 1}, 'reuses_metrics': {}}
+
+
+def test_gather_metrics_sequentially(app):
+    app.config['METRICS_COMPUTE_WORKERS'] = 0
+
+    res = gather_metrics(sleeping(0, {'visit': {}}), sleeping(0, {'followers_metrics': {}}))
+
+    assert res == {'visit': {}, 'followers_metrics': {}}
+
+
+def test_gather_metrics_degraded(app):
+    app.config['METRICS_COMPUTE_DEADLINE'] = 0.1
+
+    assert not gather_metrics(sleeping(0, {'visit': {}})).degraded
+    assert gather_metrics(sleeping(0.3, {'visit': {}})).degraded
+
+
+def test_gather_metrics_inline_when_saturated(app):
+    app.config['METRICS_COMPUTE_WORKERS'] = 1
+    app.config['METRICS_COMPUTE_DEADLINE'] = 0.1
+    # The part past its deadline keeps the only worker busy
+    gather_metrics(sleeping(0.5, {'visit': {}}))
+
+    res = gather_metrics(sleeping(0.2, {'followers_metrics': {'2024-01': 2}}))
+
+    assert res == {'followers_metrics': {'2024-01': 2}}
+    assert not res.degraded
+
+
+def test_gather_metrics_degraded_part(app):
+    def fallback():
+        metrics = GatheredMetrics(visit={})
+        metrics.degraded = True
+        return metrics
+
+    res = gather_metrics((['visit'], fallback), sleeping(0, {'followers_metrics': {}}))
+
+    assert res == {'visit': {}, 'followers_metrics': {}}
+    assert res.degraded
@@ -1,15 +1,24 @@
 from datetime import datetime, timedelta
+import time
+from unittest import mock
+
+from bson import DBRef
 import pytest
+import requests
 
 from udata.core.dataservices.factories import DataserviceFactory
 from udata.core.dataservices.models import Dataservice
 from udata.core.dataset.factories import DatasetFactory
 from udata.core.organization.factories import OrganizationFactory
 from udata.core.reuse.factories import ReuseFactory
-from udata.models import Dataset, Organization,  Reuse
+from udata.core.user.factories import UserFactory
+from udata.models import Dataset, Follow, Organization,  Reuse
 
+from udata_metrics import client
+from udata_metrics.models import MetricsSeries
 from udata_metrics.metrics import (
-    get_metrics_for_model, get_stock_metrics
+    FallbackSeries, get_last_13_months, get_metrics_for_model, get_metrics_for_models,
+    get_organization_stock_metrics, get_stock_metrics
 )
 from .helpers import mock_monthly_metrics_payload
 
@@ -20,7 +29,7 @@ from .helpers import mock_monthly_metrics_payload
     ('reuse', ['visit']),
     ('organization', ['visit_dataset', 'download_resource', 'visit_reuse'])
 ])
-def test_get_metrics_for_model(app, rmock, target, value_keys):
+def test_get_metrics_for_model(app, clean_db, rmock, target, value_keys):
     mock_monthly_metrics_payload(app, rmock, target,
                                  data=[(value_key, 2403) for value_key in value_keys])
     res = get_metrics_for_model(target, 'id', value_keys)
@@ -30,7 +39,16 @@ def test_get_metrics_for_model(app, rmock, target, value_keys):
         assert list(res[i].values())[-2] == len(key)*2403
 
 
-def test_get_metrics_for_site(app, rmock):
+def test_get_metrics_for_model_query(app, clean_db, rmock):
+    mock_monthly_metrics_payload(app, rmock, 'dataset', data=[('visit', 2403)])
+    get_metrics_for_model('dataset', 'id', ['visit', 'download_resource'])
+
+    qs = rmock.request_history[0].qs
+    assert qs['metric_month__greater'] == [get_last_13_months()[0]]
+    assert qs['columns'] == ['metric_month,monthly_visit,monthly_download_resource']
+
+
+def test_get_metrics_for_site(app, clean_db, rmock):
     value_keys = ['visit_dataset', 'download_resource', ]
     url = f'{app.config["METRICS_API"]}/site/data/?metric_month__sort=desc'
     mock_monthly_metrics_payload(app, rmock, 'site',
@@ -42,6 +60,27 @@ def test_get_metrics_for_site(app, rmock):
         assert list(res[i].values())[-2] == len(key)*2403
 
 
+def test_get_metrics_for_models(app, clean_db, rmock):
+    app.config['METRICS_API_BATCH_SIZE'] = 2
+    current_month = datetime.now().strftime('%Y-%m')
+    url = f'{app.config["METRICS_API"]}/datasets/data/?metric_month__sort=desc'
+    rmock.get(f'{url}&dataset_id__in=a,b', json={
+        'data': [
+            {'dataset_id': 'a', 'metric_month': current_month, 'monthly_visit': 12},
+            {'dataset_id': 'b', 'metric_month': current_month, 'monthly_visit': 3},
+        ],
+    })
+    rmock.get(f'{url}&dataset_id__in=c', json={'data': []})
+
+    res = get_metrics_for_models('dataset', ['a', 'b', 'c'], ['visit'])
+
+    assert rmock.call_count == 2
+    assert rmock.request_history[0].qs['page_size'] == ['26']
+    assert list(res['a'][0].values())[-1] == 12
+    assert list(res['b'][0].values())[-1] == 3
+    assert list(res['c'][0].values()) == [0] * 13
+
+
 @pytest.mark.parametrize('model,factory,date_label', [
     (Dataset, DatasetFactory, 'created_at_internal'),
     (Dataservice, DataserviceFactory, 'created_at'),
@@ -55,3 +94,130 @@ def test_get_stock_metrics(app, clean_db, model, factory, date_label):
     assert list(res.values())[-1] == 10
     assert list(res.values())[-2] == 8
     assert list(res.values())[-3] == 0
+
+
+def test_get_organization_stock_metrics(app, clean_db):
+    org = OrganizationFactory()
+    datasets = [DatasetFactory(organization=org) for i in range(3)]
+    DatasetFactory(organization=org, private=True)
+    DatasetFactory()
+    ReuseFactory(organization=org)
+    # A reuse of several of the organization datasets is counted once
+    ReuseFactory(datasets=datasets[:2])
+    ReuseFactory(datasets=datasets[:1], private=True)
+    for dataset in datasets[:2]:
+        Follow.objects.create(follower=UserFactory(), following=dataset)
+    Follow.objects.create(follower=UserFactory(), following=ReuseFactory(organization=org))
+
+    res = get_organization_stock_metrics(org.id)
+
+    assert list(res['dataset_metrics'].values())[-1] == 3
+    assert list(res['reuse_metrics'].values())[-1] == 2
+    assert list(res['dataset_follower_metrics'].values())[-1] == 2
+    assert list(res['reuse_follower_metrics'].values())[-1] == 1
+    assert list(res['dataset_reuse_metrics'].values())[-1] == 1
+
+
+def test_get_organization_stock_metrics_indexed_queries(app, clean_db):
+    org = OrganizationFactory()
+    dataset = DatasetFactory(organization=org)
+
+    with mock.patch('udata_metrics.metrics.get_stock_metrics_series') as get_series:
+        get_organization_stock_metrics(org.id)
+
+    series = get_series.call_args[0][1]
+    # No per-dataset join, follows are matched on their indexed `following` subdocument
+    assert not any('$lookup' in stage for _, stages, _ in series.values() for stage in stages)
+    assert series['dataset_follower_metrics'][1] == [{'$match': {'following': {'$in': [
+        {'_cls': 'Dataset', '_ref': DBRef('dataset', dataset.id)}
+    ]}}}]
+
+
+def mirror_series(object_id, series, updated_at=None):
+    MetricsSeries.objects.create(model='dataset', object_id=object_id,
+                                 start=get_last_13_months()[0], series=series,
+                                 updated_at=updated_at or datetime.utcnow())
+
+
+def test_get_metrics_for_model_reads_fresh_series(app, clean_db, rmock):
+    mirror_series('id', {'visit': list(range(13))})
+
+    res = get_metrics_for_model('dataset', 'id', ['visit'])
+
+    assert list(res[0].values()) == list(range(13))
+    assert rmock.call_count == 0
+
+
+def test_metrics_api_client_reuses_session(app, rmock):
+    app.config['METRICS_API_CONNECT_TIMEOUT'] = 2
+    url = f'{app.config["METRICS_API"]}/site/data/'
+    rmock.get(url, json={'data': []})
+
+    client.get(url)
+    client.get(url)
+
+    assert client.get_session() is client.get_session()
+    assert [request.timeout for request in rmock.request_history] == [(2, 10), (2, 10)]
+
+
+def test_metrics_api_client_view_session(app, rmock):
+    app.config['METRICS_API_VIEW_READ_TIMEOUT'] = 2
+    url = f'{app.config["METRICS_API"]}/site/data/'
+    rmock.get(url, json={'data': []})
+
+    client.get(url, view=True)
+
+    assert client.get_session(view=True) is not client.get_session()
+    assert client.get_session(view=True).get_adapter(url).max_retries.total == 0
+    assert rmock.request_history[0].timeout == (1, 2)
+
+
+def test_metrics_api_circuit_breaker(app, rmock):
+    app.config['METRICS_API_BREAKER_THRESHOLD'] = 2
+    app.config['METRICS_API_BREAKER_RESET'] = 0.05
+    app.config['METRICS_API_RETRIES'] = 0
+    url = f'{app.config["METRICS_API"]}/site/data/'
+    rmock.get(url, [{'status_code': 500}, {'status_code': 500}, {'json': {'data': []}}])
+
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.get(url)
+    with pytest.raises(client.CircuitOpenError):
+        client.get(url)
+    assert rmock.call_count == 2
+
+    client.breaker.prober.join(timeout=1)
+    assert not client.breaker.is_open
+    assert rmock.call_count == 3
+    client.get(url)
+
+
+def test_get_metrics_for_model_last_known_good(app, clean_db, rmock, metrics_api_breaker):
+    mirror_series('id', {'visit': [1] * 13, 'download_resource': [2] * 13},
+                  updated_at=datetime.utcnow() - timedelta(days=5))  # Not fresh anymore
+    metrics_api_breaker.opened_at = time.time()
+
+    res = get_metrics_for_model('dataset', 'id', ['visit', 'download_resource'])
+
+    assert [list(series.values()) for series in res] == [[1] * 13, [2] * 13]
+    assert get_metrics_for_model('dataset', 'other', ['visit']) == [{}]
+    assert rmock.call_count == 0
+
+
+def test_get_metrics_for_model_does_not_write(app, clean_db, rmock):
+    mock_monthly_metrics_payload(app, rmock, 'dataset', data=[('visit', 2403)])
+
+    get_metrics_for_model('dataset', 'id', ['visit'])
+
+    assert MetricsSeries.objects.count() == 0
+
+
+def test_get_metrics_fallback_on_api_error(app, clean_db, rmock):
+    rmock.get(rmock.ANY, status_code=500)
+
+    res = get_metrics_for_model('dataset', 'id', ['visit'])
+    batch = get_metrics_for_models('dataset', ['id'], ['visit'])
+
+    assert isinstance(res, FallbackSeries)
+    assert res == [{}]
+    assert isinstance(batch['id'], FallbackSeries)
@@ -0,0 +1,60 @@
+from flask import Response
+
+from udata.app import cache
+from udata.core.dataset.factories import DatasetFactory
+from udata.models import Dataset
+
+from udata_metrics import client, profiling
+from udata_metrics.cache import cached_metrics
+from udata_metrics.executor import gather_metrics
+from udata_metrics.metrics import get_stock_metrics
+
+
+def test_profile_server_timing():
+    profile = profiling.Profile()
+    profile.add('metrics-cache', desc='get_dataset_metrics hit')
+    profile.add('metrics-render', 12.345, 'dataset-metrics.html')
+
+    assert profile.server_timing() == (
+        'metrics-cache;desc="get_dataset_metrics hit", '
+        'metrics-render;dur=12.3;desc="dataset-metrics.html"'
+    )
+
+
+def test_unsampled_request_is_not_profiled(app):
+    app.config['METRICS_PROFILING_SAMPLE_RATE'] = 0
+    with app.test_request_context('/'):
+        profiling.start_request()
+        with profiling.timing('metrics-render'):
+            pass
+
+        assert profiling.get_profile() is None
+        assert 'Server-Timing' not in profiling.report(Response()).headers
+
+
+def test_sampled_request_timings(app, clean_db, rmock):
+    app.config['METRICS_PROFILING_SAMPLE_RATE'] = 1
+    cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+    rmock.get(f'{app.config["METRICS_API"]}/site/data/', json={'data': []})
+    DatasetFactory()
+
+    @cached_metrics
+    def profiled_metrics():
+        return gather_metrics(
+            (['visit'], lambda: {'visit': client.get(f'{app.config["METRICS_API"]}/site/data/')}),
+            (['dataset_metrics'], lambda: {'dataset_metrics': get_stock_metrics(
+                Dataset.objects(), date_label='created_at_internal')}),
+        )
+
+    with app.test_request_context('/'):
+        profiling.start_request()
+        profiled_metrics()
+        profiled_metrics()
+        server_timing = profiling.report(Response()).headers['Server-Timing']
+
+    names = [metric.split(';')[0] for metric in server_timing.split(', ')]
+    assert names.count('metrics-api') == 1
+    assert names.count('metrics-stock') == 1
+    assert names.count('metrics-compute') == 1
+    assert 'metrics-cache;desc="profiled_metrics miss"' in server_timing
+    assert 'metrics-cache;desc="profiled_metrics hit"' in server_timing
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from udata.core.dataset.factories import DatasetFactory
+from udata.core.organization.factories import OrganizationFactory
+from udata.core.reuse.factories import ReuseFactory
+from udata.core.user.factories import UserFactory
+from udata.models import Follow
+
+from udata_metrics.models import MetricsRollup
+from udata_metrics.rollups import get_rollup_metrics, update_rollups
+
+
+def last_month():
+    return datetime.now().replace(day=1) - timedelta(days=1)
+
+
+def test_update_site_rollups(app, clean_db):
+    [DatasetFactory() for i in range(3)]
+    [DatasetFactory(created_at_internal=last_month()) for i in range(2)]
+    DatasetFactory(private=True)
+
+    update_rollups()
+    res = get_rollup_metrics('site')
+
+    assert list(res['dataset_metrics'].values())[-2:] == [2, 3]
+    assert len(res['user_metrics']) == 13
+
+
+def test_update_rollups_removes_emptied_months(app, clean_db):
+    dataset = DatasetFactory()
+    follow = Follow.objects.create(follower=UserFactory(), following=dataset)
+    update_rollups()
+    assert list(get_rollup_metrics('dataset', dataset.id)['followers_metrics'].values())[-1] == 1
+
+    follow.delete()
+    update_rollups()
+
+    assert list(get_rollup_metrics('dataset', dataset.id)['followers_metrics'].values())[-1] == 0
+
+
+def test_update_rollups_removes_partly_emptied_months(app, clean_db):
+    org = OrganizationFactory()
+    DatasetFactory(organization=org)
+    previous = DatasetFactory(organization=org, created_at_internal=last_month())
+    update_rollups()
+    assert list(get_rollup_metrics('organization', org.id)['dataset_metrics'].values())[-2:] == [1, 1]
+
+    previous.delete()
+    update_rollups()
+
+    assert list(get_rollup_metrics('organization', org.id)['dataset_metrics'].values())[-2:] == [0, 1]
+
+
+def test_update_rollups_by_scope(app, clean_db):
+    org = OrganizationFactory()
+    datasets = [DatasetFactory(organization=org) for i in range(2)]
+    ReuseFactory(datasets=datasets)
+    ReuseFactory(organization=org, datasets=datasets[:1])
+
+    update_rollups()
+
+    org_metrics = get_rollup_metrics('organization', org.id)
+    assert list(org_metrics['dataset_metrics'].values())[-1] == 2
+    assert list(org_metrics['reuse_metrics'].values())[-1] == 1
+    assert list(org_metrics['dataset_reuse_metrics'].values())[-1] == 2
+    dataset_metrics = get_rollup_metrics('dataset', datasets[0].id)
+    assert list(dataset_metrics['reuses_metrics'].values())[-1] == 2
+    assert MetricsRollup.objects(scope='reuse').count() == 0
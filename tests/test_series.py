@@ -0,0 +1,36 @@
+from collections import OrderedDict
+from datetime import date
+import json
+import pickle
+
+from udata_metrics.metrics import get_last_13_months
+from udata_metrics.series import MonthSeries, months_from, months_window
+
+
+def test_months_window():
+    assert months_window(date(2024, 3, 15)) == months_from('2023-03')
+    assert months_window(date(2024, 3, 15))[-1] == '2024-03'
+    assert get_last_13_months() is get_last_13_months()
+
+
+def test_month_series_mapping():
+    months = months_from('2023-12')
+    series = MonthSeries(months, range(13))
+
+    assert list(series.keys())[:2] == ['2023-12', '2024-01']
+    assert list(series.values()) == list(range(13))
+    assert series['2024-12'] == 12
+    assert series == OrderedDict(zip(months, range(13)))
+    assert MonthSeries(months) == dict.fromkeys(months, 0)
+    assert MonthSeries.from_counts(months, {'2024-01': 3})['2024-01'] == 3
+
+
+def test_month_series_serialization(app):
+    months = months_from('2023-12')
+    series = MonthSeries(months, range(13))
+
+    dumped = pickle.dumps(series)
+    assert pickle.loads(dumped) == series
+    assert len(dumped) < len(pickle.dumps(OrderedDict(series.items())))
+    with app.app_context():
+        assert json.loads(json.dumps(series, cls=app.json_encoder)) == dict(series)
@@ -0,0 +1,42 @@
+import pytest
+
+from udata_metrics.stats import Histogram, SyncStats, to_prometheus
+
+
+def test_histogram():
+    histogram = Histogram(buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+
+    assert histogram.as_dict() == {
+        'count': 4,
+        'sum': 3.65,
+        'buckets': {'0.1': 2, '1': 3, '+Inf': 4},
+    }
+
+
+def test_sync_stats_timing_counts_errors():
+    stats = SyncStats('datasets')
+    with stats.timing('http_latency'):
+        stats.incr('pages_fetched')
+    with pytest.raises(ValueError):
+        with stats.timing('http_latency'):
+            raise ValueError()
+
+    summary = stats.as_dict()
+    assert summary['pages_fetched'] == 1
+    assert summary['errors'] == 1
+    assert summary['http_latency']['count'] == 2
+
+
+def test_to_prometheus():
+    stats = SyncStats('datasets')
+    stats.incr('rows_fetched', 42)
+    stats.histograms['write_latency'].observe(0.2)
+
+    text = to_prometheus({'datasets': stats.as_dict()})
+
+    assert 'udata_metrics_sync_rows_fetched_total{step="datasets"} 42\n' in text
+    assert 'udata_metrics_sync_write_latency_seconds_bucket{step="datasets",le="0.25"} 1\n' in text
+    assert 'udata_metrics_sync_write_latency_seconds_count{step="datasets"} 1\n' in text
+    assert '# TYPE udata_metrics_sync_http_latency_seconds histogram\n' in text
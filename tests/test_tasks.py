@@ -1,14 +1,22 @@
+from datetime import datetime, timedelta
+import re
+
 import pytest
 
 from udata.core.dataservices.factories import DataserviceFactory
 from udata.core.dataset.factories import CommunityResourceFactory, DatasetFactory, ResourceFactory
 from udata.core.organization.factories import OrganizationFactory
 from udata.core.reuse.factories import ReuseFactory
+from udata.app import cache
+from udata.models import Dataset
 
+from udata_metrics.cache import cache_key
+from udata_metrics.metrics import get_last_13_months, get_metrics_for_model
+from udata_metrics.models import MetricsCheckpoint, MetricsSeries, MetricsSnapshot
 from udata_metrics.tasks import (
-    iterate_on_metrics, update_dataservices, update_datasets, update_organizations, update_resources_and_community_resources, update_reuses
+    Checkpoint, IdBitmap, Snapshot, iterate_on_metrics, pipelined, update_dataservices, update_datasets, update_metrics, update_monthly_series, update_organizations, update_resources_and_community_resources, update_reuses, warm_metrics_cache
 )
-from .helpers import mock_metrics_api
+from .helpers import mock_metrics_api, mock_metrics_csv
 
 
 def test_iterate_on_metrics(app, rmock):
@@ -26,6 +34,101 @@ def test_iterate_on_metrics(app, rmock):
         { '__id': 2, 'id': 1337 },
     ]
 
+def test_iterate_on_metrics_yields_rows_once(app, rmock):
+    # The second row has a second_key but a null test_key
+    rmock.get(f'{app.config["METRICS_API"]}/test_model_total/data/?second_key__greater=1&page_size=50', json={
+        'data': [
+            { '__id': 0, 'id': 123, 'test_key': 2, 'second_key': 3 },
+            { '__id': 1, 'id': 42, 'test_key': None, 'second_key': 5 },
+        ],
+        'links': {'next': None},
+    })
+    rmock.get(f'{app.config["METRICS_API"]}/test_model_total/data/?test_key__greater=1&page_size=50', json={
+        'data': [{ '__id': 0, 'id': 123, 'test_key': 2, 'second_key': 3 }],
+        'links': {'next': None},
+    })
+
+    metrics_data = list(iterate_on_metrics("test_model", ["test_key", 'second_key']))
+
+    assert [row['id'] for row in metrics_data] == [123, 42]
+    assert rmock.request_history[1].qs == {
+        'second_key__greater': ['1'],
+        'page_size': ['50'],
+    }
+
+@pytest.mark.parametrize('age,expected_ids', [
+    (timedelta(minutes=5), [2]),
+    (timedelta(days=5), [0, 1, 2]),  # Expired checkpoint
+])
+def test_iterate_on_metrics_resumes_from_checkpoint(app, rmock, clean_db, age, expected_ids):
+    mock_metrics_api(app, rmock, "test_model",  ["test_key"], [
+        { 'id': 123 },
+        { 'id': 42 },
+        { 'id': 1337 },
+    ], page_size=2)
+    MetricsCheckpoint(
+        target='test_model', value_key='test_key', updated_at=datetime.utcnow() - age,
+        url=f'{app.config["METRICS_API"]}/test_model_total/data/?test_key__greater=1&page=2&page_size=2'
+    ).save()
+    checkpoint = Checkpoint('test_model')
+
+    metrics_data = list(iterate_on_metrics("test_model", ["test_key"], page_size=2,
+                                           checkpoint=checkpoint))
+
+    assert [row['__id'] for row in metrics_data] == expected_ids
+    assert checkpoint.positions == {'test_key': None}
+
+def test_iterate_on_metrics_from_csv(app, rmock):
+    mock_metrics_csv(app, rmock, "test_model",  ["test_key", 'second_key'], [
+        { 'id': 'abc', 'parent_id': None, 'test_key': 12, 'second_key': 0 },
+        { 'id': 'def', 'parent_id': 'ghi', 'test_key': 0, 'second_key': 3 },
+    ])
+
+    metrics_data = list(iterate_on_metrics("test_model", ["test_key", 'second_key'],
+                                           from_csv=True))
+
+    assert metrics_data == [
+        { '__id': 0, 'id': 'abc', 'parent_id': None, 'test_key': 12, 'second_key': 0 },
+        { '__id': 1, 'id': 'def', 'parent_id': 'ghi', 'test_key': 0, 'second_key': 3 },
+    ]
+    assert rmock.call_count == 2
+
+def test_id_bitmap():
+    ids = IdBitmap()
+    for id in (0, 7, 8, 1337, 42):
+        ids.add(id)
+
+    assert all(id in ids for id in (0, 7, 8, 1337, 42))
+    assert not any(id in ids for id in (1, 9, 41, 1336, 100000))
+    assert len(ids.bits) < 1337
+
+def test_pipelined(app):
+    app.config['METRICS_SYNC_QUEUE_SIZE'] = 2
+
+    def iterate(count, checkpoint=None):
+        for i in range(count):
+            yield { '__id': i }
+
+    assert list(pipelined(iterate, 1234)) == [{ '__id': i } for i in range(1234)]
+
+def test_pipelined_raises_fetching_errors(app):
+    def iterate(checkpoint=None):
+        yield { '__id': 0 }
+        raise ValueError('Metrics API error')
+
+    with pytest.raises(ValueError):
+        list(pipelined(iterate))
+
+def test_iterate_on_metrics_concurrently(app, rmock):
+    values = [{ 'id': i } for i in range(9)]
+    mock_metrics_api(app, rmock, "test_model",  ["test_key", 'second_key'], values, page_size=2)
+
+    metrics_data = list(iterate_on_metrics("test_model", ["test_key", 'second_key'], page_size=2,
+                                           concurrency=3))
+
+    assert metrics_data == [{ '__id': i, 'id': i } for i in range(9)]
+    assert rmock.call_count == 10  # 5 pages per value key
+
 @pytest.mark.parametrize('endpoint,id_key,factory,func,api_key', [
     ("dataservices", "dataservice_id", DataserviceFactory, update_dataservices, 'visit'),
     ("reuses", "reuse_id", ReuseFactory, update_reuses, 'visit'),
@@ -65,6 +168,73 @@ def test_update_datasets(app, rmock):
     assert datasets[4].metrics.get('views') == 2
     assert datasets[4].metrics.get('resources_downloads') == 7
 
+def test_update_datasets_stats(app, rmock):
+    datasets = [DatasetFactory() for i in range(3)]
+    mock_metrics_api(app, rmock, "datasets", ["visit", "download_resource"], [
+        { 'dataset_id': str(dataset.id), 'visit': 42, 'download_resource': 123 }
+        for dataset in datasets
+    ])
+
+    stats = update_datasets()
+
+    assert stats['pages_fetched'] == 2  # One page per value key
+    assert stats['rows_fetched'] == 6
+    assert stats['writes'] == 3
+    assert stats['matched'] == 3
+    assert stats['errors'] == 0
+    assert stats['http_latency']['count'] == 2
+    assert stats['write_latency']['count'] == 1
+
+def test_update_datasets_in_batches(app, rmock):
+    app.config['METRICS_BULK_BATCH_SIZE'] = 2
+    datasets = [DatasetFactory() for i in range(5)]
+    mock_metrics_api(app, rmock, "datasets", ["visit", "download_resource"], [
+        { 'dataset_id': str(dataset.id), 'visit': i + 2, 'download_resource': i + 5 }
+        for i, dataset in enumerate(datasets)
+    ] + [
+        { 'dataset_id': 'not-an-id', 'visit': 3, 'download_resource': 3 },
+    ])
+
+    update_datasets()
+    [model.reload() for model in datasets]
+
+    for i, dataset in enumerate(datasets):
+        assert dataset.metrics.get('views') == i + 2
+        assert dataset.metrics.get('resources_downloads') == i + 5
+
+def test_update_datasets_skips_unchanged_metrics(app, rmock):
+    datasets = [DatasetFactory() for i in range(2)]
+    mock_metrics_api(app, rmock, "datasets", ["visit", "download_resource"], [
+        { 'dataset_id': str(datasets[0].id), 'visit': 42, 'download_resource': 123 },
+        { 'dataset_id': str(datasets[1].id), 'visit': 1337, 'download_resource': 4242 },
+    ])
+    update_datasets()
+    # Altered outside of the job, but unchanged in the metrics API
+    Dataset.objects(id__in=[d.id for d in datasets]).update(set__metrics__views=0)
+
+    update_datasets()
+    [model.reload() for model in datasets]
+    assert datasets[0].metrics.get('views') == 0
+    assert datasets[1].metrics.get('views') == 0
+
+    app.config['METRICS_INCREMENTAL_UPDATE'] = False
+    update_datasets()
+    [model.reload() for model in datasets]
+    assert datasets[0].metrics.get('views') == 42
+    assert datasets[1].metrics.get('views') == 1337
+
+def test_snapshot_loads_batch_values(app, clean_db):
+    MetricsSnapshot.objects.create(model='Dataset', object_id='abc', values=[1, 2])
+    MetricsSnapshot.objects.create(model='Dataset', object_id='def', values=[3, 4])
+    MetricsSnapshot.objects.create(model='Reuse', object_id='abc', values=[5])
+    snapshot = Snapshot('Dataset')
+
+    snapshot.load(['abc', 'ghi'])
+
+    assert snapshot.values == {'abc': (1, 2)}
+    assert not snapshot.has_changed('abc', {'views': 1, 'resources_downloads': 2})
+    assert snapshot.has_changed('ghi', {'views': 1, 'resources_downloads': 2})
+
 def test_update_resources_metrics(app, rmock):
     resources = [ResourceFactory() for i in range(5)]
     dataset_a_with_resources = DatasetFactory(resources=resources)
@@ -100,3 +270,96 @@ def test_update_resources_metrics(app, rmock):
     assert dataset_a_with_resources.resources[4].metrics.get('views') == 2
 
     assert dataset_b_with_resource.resources[0].metrics.get('views') == 1404
+
+@pytest.mark.parametrize('parallel', [False, True])
+def test_update_metrics_job(app, rmock, parallel):
+    app.config['METRICS_UPDATE_PARALLEL'] = parallel
+    dataset = DatasetFactory(resources=[ResourceFactory()])
+    dataservice = DataserviceFactory()
+    reuse = ReuseFactory()
+    organization = OrganizationFactory()
+    mock_metrics_api(app, rmock, "datasets", ["visit", "download_resource"], [
+        { 'dataset_id': str(dataset.id), 'visit': 42, 'download_resource': 123 },
+    ])
+    mock_metrics_api(app, rmock, "resources", ["download_resource"], [
+        { 'resource_id': str(dataset.resources[0].id), 'dataset_id': str(dataset.id), 'download_resource': 123 },
+    ])
+    mock_metrics_api(app, rmock, "dataservices", ["visit"], [
+        { 'dataservice_id': str(dataservice.id), 'visit': 2 },
+    ])
+    mock_metrics_api(app, rmock, "reuses", ["visit"], [
+        { 'reuse_id': str(reuse.id), 'visit': 3 },
+    ])
+    mock_metrics_api(app, rmock, "organizations", ["visit_dataset"], [
+        { 'organization_id': str(organization.id), 'visit_dataset': 4 },
+    ])
+    rmock.get(re.compile(r'.*/(datasets|reuses|organizations|site)/data/'),
+              json={'data': [], 'links': {}})
+
+    update_metrics()
+    [model.reload() for model in (dataset, dataservice, reuse, organization)]
+
+    assert dataset.metrics.get('views') == 42
+    assert dataset.resources[0].metrics.get('views') == 123
+    assert dataservice.metrics.get('views') == 2
+    assert reuse.metrics.get('views') == 3
+    assert organization.metrics.get('views') == 4
+
+
+def test_warm_metrics_cache(app, rmock, clean_db):
+    from udata_metrics.views import get_dataset_metrics, get_site_metrics
+
+    cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+    app.config['METRICS_CACHE_WARM_COUNT'] = 2
+    datasets = [DatasetFactory(metrics={'views': i}) for i in range(4)]
+    rmock.get(rmock.ANY, json={'data': []})
+    assert get_site_metrics.acquire()  # Computed by a web worker
+
+    warm_metrics_cache()
+
+    assert cache.get(get_site_metrics.cache_key()) is not None
+    assert not get_site_metrics.acquire()  # The worker lock is kept
+    assert [cache.get(get_dataset_metrics.cache_key(dataset.id)) is not None
+            for dataset in datasets] == [False, False, True, True]
+
+def test_update_datasets_invalidates_view_metrics_cache(app, rmock):
+    cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+    datasets = [DatasetFactory() for i in range(2)]
+    for dataset in datasets:
+        cache.set(cache_key('get_dataset_metrics', dataset.id), (0, {}))
+    mock_metrics_api(app, rmock, "datasets", ["visit", "download_resource"], [
+        { 'dataset_id': str(datasets[0].id), 'visit': 42, 'download_resource': 123 },
+    ])
+
+    update_datasets()
+
+    assert cache.get(cache_key('get_dataset_metrics', datasets[0].id)) is None
+    assert cache.get(cache_key('get_dataset_metrics', datasets[1].id)) is not None
+
+
+def test_update_monthly_series(app, clean_db, rmock):
+    months = get_last_13_months()
+    rmock.get(re.compile(r'.*/(reuses|organizations|site)/data/'), json={'data': [], 'links': {}})
+    rmock.get(re.compile(r'.*/datasets/data/\?.*dataset_id__sort=asc.*page_size=50'), json={
+        'data': [
+            {'dataset_id': 'a', 'metric_month': months[-1], 'monthly_visit': 3},
+            {'dataset_id': 'a', 'metric_month': months[-2], 'monthly_visit': 2,
+             'monthly_download_resource': 1},
+            {'dataset_id': 'b', 'metric_month': months[-1], 'monthly_visit': 5},
+        ],
+        'links': {},
+    })
+    cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+    # Computed from the previous series after the datasets step invalidation
+    cache.set(cache_key('get_dataset_metrics', 'a'), (0, {}))
+
+    stats = update_monthly_series()
+
+    assert cache.get(cache_key('get_dataset_metrics', 'a')) is None
+    assert stats['writes'] == 2
+    assert MetricsSeries.objects(model='dataset').count() == 2
+    call_count = rmock.call_count
+    visit, download_resource = get_metrics_for_model('dataset', 'a', ['visit', 'download_resource'])
+    assert rmock.call_count == call_count
+    assert list(visit.values())[-2:] == [2, 3]
+    assert list(download_resource.values())[-2:] == [1, 0]
@@ -1,6 +1,11 @@
+import time
+from unittest import mock
+
 import pytest
 
-from flask import render_template_string, g
+from flask import render_template_string, g, url_for
+
+from udata.app import cache
 
 from udata.core.dataset.factories import DatasetFactory
 from udata.core.organization.factories import OrganizationFactory
@@ -44,3 +49,87 @@ class MetricsBlueprintTest:
         mock_monthly_metrics_payload(app, rmock, 'site', data=data, url=url)
         response = render_hook('site.display.metrics')
         assert 'Download traffic metrics as CSV' in response
+
+    def test_render_cached_fragment(self, app, rmock):
+        '''It should only render the metrics once until they are refreshed'''
+        cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+        dataset = DatasetFactory()
+        mock_monthly_metrics_payload(app, rmock, 'dataset', data=[('visit', 2403)],
+                                     target_id=dataset.id)
+        response = render_hook('dataset.display.metrics', dataset=dataset)
+
+        with mock.patch('udata_metrics.views.theme.render') as render:
+            assert render_hook('dataset.display.metrics', dataset=dataset) == response
+        render.assert_not_called()
+
+    def test_render_fragment_with_live_counters(self, app, rmock):
+        '''It should render the metrics again when the displayed counters change'''
+        cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+        dataset = DatasetFactory()
+        mock_monthly_metrics_payload(app, rmock, 'dataset', data=[('visit', 2403)],
+                                     target_id=dataset.id)
+        render_hook('dataset.display.metrics', dataset=dataset)
+        dataset.metrics['followers'] = 42
+
+        with mock.patch('udata_metrics.views.theme.render', return_value='') as render:
+            render_hook('dataset.display.metrics', dataset=dataset)
+        render.assert_called_once()
+
+    def test_render_placeholder(self, app, rmock):
+        '''It should render a placeholder while computing uncached metrics'''
+        app.config['METRICS_HOOKS_PLACEHOLDER'] = True
+        app.config['METRICS_CACHE_ASYNC_REFRESH'] = True
+        dataset = DatasetFactory()
+
+        with mock.patch('udata_metrics.tasks.refresh_metrics_cache.delay') as delay:
+            response = render_hook('dataset.display.metrics', dataset=dataset)
+
+        assert url_for('metrics.model_metrics_json', model='dataset', id=dataset.id) in response
+        delay.assert_called_once_with('get_dataset_metrics', [str(dataset.id)])
+
+    def test_site_metrics_json(self, app, client, rmock):
+        '''It should serve the site metrics with their version as ETag'''
+        cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+        data = [('visit_dataset', 337), ('download_resource', 42)]
+        url = f'{app.config["METRICS_API"]}/site/data/?metric_month__sort=desc'
+        mock_monthly_metrics_payload(app, rmock, 'site', data=data, url=url)
+
+        response = client.get(url_for('metrics.site_metrics_json'))
+        assert response.status_code == 200
+        assert list(response.json['visit_dataset'].values())[-1] == len('visit_dataset')*337+1
+        assert response.cache_control.max_age > 0
+
+        response = client.get(url_for('metrics.site_metrics_json'),
+                              headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+
+    def test_model_metrics_json_not_found(self, app, client):
+        response = client.get(url_for('metrics.model_metrics_json', model='dataset',
+                                      id='6572e7fd5e2ff9f3b1a3e2b1'))
+        assert response.status_code == 404
+
+    def test_metrics_server_timing(self, app, client, rmock):
+        '''It should report the metrics timings of sampled requests'''
+        app.config['METRICS_PROFILING_SAMPLE_RATE'] = 1
+        url = f'{app.config["METRICS_API"]}/site/data/?metric_month__sort=desc'
+        mock_monthly_metrics_payload(app, rmock, 'site', data=[('visit_dataset', 337)], url=url)
+
+        response = client.get(url_for('metrics.site_metrics_json'))
+
+        server_timing = response.headers['Server-Timing']
+        assert 'metrics-cache;desc="get_site_metrics miss"' in server_timing
+        assert 'metrics-api;dur=' in server_timing
+        assert 'metrics-stock;dur=' in server_timing
+
+    def test_metrics_degraded_on_api_error(self, app, rmock):
+        '''It should only cache the metrics briefly if the metrics API fails'''
+        from udata_metrics.views import get_dataset_metrics
+        cache.init_app(app, config={'CACHE_TYPE': 'flask_caching.backends.simple'})
+        app.config['METRICS_CACHE_DEGRADED_TTL'] = 60
+        dataset = DatasetFactory()
+        rmock.get(rmock.ANY, status_code=500)
+
+        fresh_until, metrics = get_dataset_metrics.lookup(dataset.id)
+
+        assert metrics.degraded
+        assert fresh_until < time.time() + 61
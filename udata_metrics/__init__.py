@@ -12,3 +12,13 @@ __description__ = 'Connexion handler to metrics service for udata'
 def init_app(app):
     # Do whatever you want to initialize your plugin
     pass
+
+
+def get_config(key):
+    '''
+    Get a plugin setting from the app config,
+    falling back on the default value from `udata_metrics.settings`
+    '''
+    from flask import current_app
+    from udata_metrics import settings
+    return current_app.config.get(key, getattr(settings, key))
@@ -0,0 +1,156 @@
+'''
+Stale-while-revalidate caching of the view metrics
+'''
+from functools import update_wrapper
+import logging
+import threading
+import time
+from typing import Any, Callable, Iterable, Optional, Tuple
+
+from flask import current_app
+from udata.app import cache
+
+from udata_metrics import get_config, profiling
+
+
+log = logging.getLogger(__name__)
+
+# Cached functions by name, to be refreshed by the `refresh-metrics-cache` task
+cached_functions = {}
+
+
+def cache_key(name: str, *args) -> str:
+    return ':'.join(['udata_metrics', name, *(str(arg) for arg in args)])
+
+
+def invalidate(name: str, ids: Iterable) -> None:
+    '''
+    Delete the cached entries of a single argument metrics function for several ids,
+    so that they are computed again on their next call
+    '''
+    keys = [cache_key(name, id) for id in ids]
+    if keys:
+        cache.delete_many(*keys)
+
+
+class CachedMetrics(object):
+    '''
+    Cache a metrics function result by arguments, as their string representation.
+    Entries are fresh for `METRICS_CACHE_SOFT_TTL` seconds, then served stale
+    up to `METRICS_CACHE_HARD_TTL` seconds while a single worker refreshes them,
+    in a background thread or in a Celery task if `METRICS_CACHE_ASYNC_REFRESH` is set.
+    Entries of the objects updated by the update-metrics job are invalidated,
+    and degraded entries are refreshed after `METRICS_CACHE_DEGRADED_TTL` seconds.
+    Refreshes and cold computations are coordinated with a short-lived lock
+    in the cache, so that concurrent requests don't compute the same entry.
+    '''
+
+    def __init__(self, func: Callable):
+        self.func = func
+        self.name = func.__name__
+        update_wrapper(self, func)
+        cached_functions[self.name] = self
+
+    def cache_key(self, *args) -> str:
+        return cache_key(self.name, *args)
+
+    def acquire(self, *args) -> bool:
+        '''Try to get the lock to compute an entry'''
+        timeout = get_config('METRICS_CACHE_LOCK_TIMEOUT')
+        return bool(cache.add(f'{self.cache_key(*args)}:lock', True, timeout=timeout))
+
+    def release(self, *args) -> None:
+        cache.delete(f'{self.cache_key(*args)}:lock')
+
+    def store(self, value: Any, *args) -> float:
+        '''
+        Store an entry, returning its freshness deadline.
+        Degraded metrics, missing some series, are only fresh for `METRICS_CACHE_DEGRADED_TTL`,
+        and metrics with stock series computed live instead of read from the rollups
+        for `METRICS_CACHE_LIVE_STOCK_TTL` at most, as nothing invalidates them.
+        '''
+        if getattr(value, 'degraded', False):
+            log.warning(f'Caching degraded metrics {self.name}{args}')
+            fresh_until = time.time() + get_config('METRICS_CACHE_DEGRADED_TTL')
+        elif get_config('METRICS_STOCK_ROLLUPS'):
+            fresh_until = time.time() + get_config('METRICS_CACHE_SOFT_TTL')
+        else:
+            fresh_until = time.time() + min(get_config('METRICS_CACHE_SOFT_TTL'),
+                                            get_config('METRICS_CACHE_LIVE_STOCK_TTL'))
+        cache.set(self.cache_key(*args), (fresh_until, value),
+                  timeout=get_config('METRICS_CACHE_HARD_TTL'))
+        return fresh_until
+
+    def delete(self, *args) -> None:
+        cache.delete(self.cache_key(*args))
+
+    def refresh(self, *args) -> Any:
+        '''Compute and store an entry, releasing its lock'''
+        return self.compute(*args)[1]
+
+    def compute(self, *args) -> Tuple[float, Any]:
+        try:
+            value = self.func(*args)
+            return self.store(value, *args), value
+        finally:
+            self.release(*args)
+
+    def refresh_in_background(self, *args) -> None:
+        if get_config('METRICS_CACHE_ASYNC_REFRESH'):
+            from udata_metrics.tasks import refresh_metrics_cache
+            refresh_metrics_cache.delay(self.name, [str(arg) for arg in args])
+            return
+        app = current_app._get_current_object()
+
+        def refresh():
+            with app.app_context():
+                try:
+                    self.refresh(*args)
+                except Exception as e:
+                    log.exception(f'Error while refreshing {self.name}{args}: {e}')
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def __call__(self, *args) -> Any:
+        return self.lookup(*args)[1]
+
+    def peek(self, *args) -> Optional[Tuple[float, Any]]:
+        '''
+        Get a cached entry with its freshness deadline, refreshing it in background if stale
+        '''
+        entry = cache.get(self.cache_key(*args))
+        if entry is None:
+            profiling.record('metrics-cache', f'{self.name} miss')
+        elif entry[0] < time.time():
+            profiling.record('metrics-cache', f'{self.name} stale')
+            if self.acquire(*args):
+                self.refresh_in_background(*args)
+        else:
+            profiling.record('metrics-cache', f'{self.name} hit')
+        return entry
+
+    def lookup(self, *args) -> Tuple[Optional[float], Any]:
+        '''
+        Get an entry with its freshness deadline, which identifies its version,
+        `None` if it has been computed without being stored
+        '''
+        entry = self.peek(*args)
+        if entry is not None:
+            return entry
+        if self.acquire(*args):
+            with profiling.timing('metrics-compute', self.name):
+                return self.compute(*args)
+        # Another worker is computing this entry, wait for it a bit before computing it too
+        deadline = time.time() + get_config('METRICS_CACHE_WAIT')
+        with profiling.timing('metrics-cache-wait', self.name):
+            while time.time() < deadline:
+                time.sleep(0.1)
+                entry = cache.get(self.cache_key(*args))
+                if entry is not None:
+                    return entry
+        with profiling.timing('metrics-compute', self.name):
+            return None, self.func(*args)
+
+
+def cached_metrics(func: Callable) -> CachedMetrics:
+    return CachedMetrics(func)
@@ -0,0 +1,153 @@
+'''
+Shared HTTP client for the metrics API
+'''
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from flask import current_app
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from udata_metrics import get_config, profiling
+
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+
+
+def build_session(view: bool = False) -> requests.Session:
+    retry = Retry(
+        total=get_config('METRICS_API_VIEW_RETRIES' if view else 'METRICS_API_RETRIES'),
+        backoff_factor=get_config('METRICS_API_RETRY_BACKOFF'),
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=('GET',),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_maxsize=get_config('METRICS_API_POOL_SIZE'), max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(view: bool = False) -> requests.Session:
+    '''
+    Get the app session of the views or of the jobs, keeping its connections alive between calls.
+    Sessions are built with their app settings, and again after a fork
+    so that processes don't share sockets.
+    '''
+    sessions = current_app.extensions.setdefault('udata_metrics_sessions', {})
+    pid, session = sessions.get(view, (None, None))
+    if session is None or pid != os.getpid():
+        with _lock:
+            pid, session = sessions.get(view, (None, None))
+            if session is None or pid != os.getpid():
+                session = build_session(view)
+                sessions[view] = (os.getpid(), session)
+    return session
+
+
+def get_timeout(view: bool = False) -> Tuple[float, float]:
+    if view:
+        return (get_config('METRICS_API_VIEW_CONNECT_TIMEOUT'),
+                get_config('METRICS_API_VIEW_READ_TIMEOUT'))
+    return get_config('METRICS_API_CONNECT_TIMEOUT'), get_config('METRICS_API_READ_TIMEOUT')
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    '''The metrics API is considered down, requests are not sent'''
+
+
+class CircuitBreaker(object):
+    '''
+    Fail fast once the metrics API has failed `METRICS_API_BREAKER_THRESHOLD` times in a row,
+    with connection errors, timeouts or server errors.
+    While open, a background thread probes the API every `METRICS_API_BREAKER_RESET` seconds
+    and closes the circuit on the first success.
+    '''
+
+    def __init__(self):
+        self.failures = 0
+        self.opened_at = None
+        self.prober = None
+        self.lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self) -> None:
+        if self.is_open:
+            # The prober thread doesn't survive a fork
+            self.start_probing()
+            raise CircuitOpenError('Metrics API circuit is open')
+
+    def success(self) -> None:
+        with self.lock:
+            self.failures = 0
+            if self.is_open:
+                log.info('Metrics API is back, closing circuit')
+            self.opened_at = None
+
+    def failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.is_open or self.failures < get_config('METRICS_API_BREAKER_THRESHOLD'):
+                return
+            log.warning(f'Metrics API failed {self.failures} times in a row, opening circuit')
+            self.opened_at = time.time()
+        self.start_probing()
+
+    def start_probing(self) -> None:
+        with self.lock:
+            if self.prober is None or not self.prober.is_alive():
+                self.prober = threading.Thread(
+                    target=self.probe, args=(current_app._get_current_object(),), daemon=True)
+                self.prober.start()
+
+    def probe(self, app) -> None:
+        with app.app_context():
+            url = f'{app.config["METRICS_API"]}/site/data/'
+            while self.is_open:
+                time.sleep(get_config('METRICS_API_BREAKER_RESET'))
+                try:
+                    send(url, {'page_size': 1}, view=True)
+                except requests.exceptions.RequestException as e:
+                    log.info(f'Metrics API is still down: {e}')
+
+
+breaker = CircuitBreaker()
+
+
+def send(url: str, params: Optional[Dict] = None, stream: bool = False,
+         view: bool = False) -> requests.Response:
+    '''GET a metrics API URL, recording the outcome in the circuit breaker'''
+    try:
+        response = get_session(view).get(url, params=params, timeout=get_timeout(view),
+                                         stream=stream)
+    except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+        breaker.failure()
+        raise
+    if response.status_code >= 500:
+        breaker.failure()
+    else:
+        breaker.success()
+    response.raise_for_status()
+    return response
+
+
+def get(url: str, params: Optional[Dict] = None, stream: bool = False,
+        view: bool = False) -> requests.Response:
+    '''
+    GET a metrics API URL and raise for error statuses,
+    or raise `CircuitOpenError` right away if the metrics API is down.
+    Requests made to render a `view` use the short `METRICS_API_VIEW_*` timeouts and retries.
+    '''
+    with profiling.timing('metrics-api'):
+        breaker.check()
+        return send(url, params, stream, view)
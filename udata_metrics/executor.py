@@ -0,0 +1,122 @@
+'''
+Shared executor running the independent parts of a view metrics computation concurrently
+'''
+from concurrent.futures import ThreadPoolExecutor, wait
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from flask import current_app
+
+from udata_metrics import get_config, profiling
+
+
+log = logging.getLogger(__name__)
+
+_executor = None
+_executor_pid = None
+_executor_workers = None
+# Workers not busy with a part, including the ones past their deadline
+_slots = None
+_lock = threading.Lock()
+
+# A part computes the series named by its keys
+Part = Tuple[List[str], Callable[[], Dict]]
+
+
+class GatheredMetrics(dict):
+    '''
+    Merged series of the parts, `degraded` if some of them are empty
+    because their computation failed or exceeded its deadline,
+    or if some of the parts are degraded
+    '''
+    degraded = False
+
+    def merge(self, metrics: Dict) -> None:
+        self.update(metrics)
+        if getattr(metrics, 'degraded', False):
+            self.degraded = True
+
+
+def get_executor() -> Optional[Tuple[ThreadPoolExecutor, threading.BoundedSemaphore]]:
+    '''
+    Get the process-wide executor with its free workers semaphore,
+    `None` if `METRICS_COMPUTE_WORKERS` is 0.
+    A new executor is built after a fork, as threads are not inherited,
+    or if `METRICS_COMPUTE_WORKERS` changed.
+    '''
+    global _executor, _executor_pid, _executor_workers, _slots
+    workers = get_config('METRICS_COMPUTE_WORKERS')
+    if not workers:
+        return None
+    if _executor is None or _executor_pid != os.getpid() or _executor_workers != workers:
+        with _lock:
+            if _executor is None or _executor_pid != os.getpid() or _executor_workers != workers:
+                if _executor is not None and _executor_pid == os.getpid():
+                    _executor.shutdown(wait=False)
+                _executor = ThreadPoolExecutor(max_workers=workers,
+                                               thread_name_prefix='udata-metrics')
+                _executor_pid = os.getpid()
+                _executor_workers = workers
+                _slots = threading.BoundedSemaphore(workers)
+    return _executor, _slots
+
+
+def gather_metrics(*parts: Part) -> GatheredMetrics:
+    '''
+    Compute the parts concurrently and merge their series.
+    Series of the parts failing or unfinished after `METRICS_COMPUTE_DEADLINE` seconds
+    are empty and the result is `degraded`, so that a slow sub-query doesn't hold
+    the whole computation.
+    Parts keep their worker until they finish, even past their deadline:
+    the parts which find no free worker are computed inline, instead of waiting
+    in the executor queue behind stuck parts.
+    '''
+    metrics = GatheredMetrics()
+    pool = get_executor()
+    if pool is None:
+        for _, compute in parts:
+            metrics.merge(compute())
+        return metrics
+    executor, slots = pool
+    app = current_app._get_current_object()
+    profile = profiling.get_profile()
+    deadline = time.monotonic() + get_config('METRICS_COMPUTE_DEADLINE')
+
+    def run(compute: Callable[[], Dict]) -> Dict:
+        with app.app_context():
+            profiling.use(profile)
+            return compute()
+
+    def failed(keys: List[str], error: Exception) -> None:
+        log.error(f'Error while computing metrics {", ".join(keys)}: {error}', exc_info=error)
+        metrics.update({key: {} for key in keys})
+        metrics.degraded = True
+
+    futures, inline = [], []
+    for keys, compute in parts:
+        if slots.acquire(blocking=False):
+            future = executor.submit(run, compute)
+            future.add_done_callback(lambda future: slots.release())
+            futures.append((keys, future))
+        else:
+            inline.append((keys, compute))
+    for keys, compute in inline:
+        log.warning(f'No free worker to compute metrics {", ".join(keys)}, computing them inline')
+        try:
+            metrics.merge(compute())
+        except Exception as e:
+            failed(keys, e)
+    wait([future for _, future in futures], timeout=max(0, deadline - time.monotonic()))
+    for keys, future in futures:
+        if not future.done():
+            log.warning(f'Metrics computation of {", ".join(keys)} exceeded its deadline')
+            metrics.update({key: {} for key in keys})
+            metrics.degraded = True
+        elif future.exception():
+            failed(keys, future.exception())
+        else:
+            metrics.merge(future.result())
+    return metrics
@@ -1,76 +1,207 @@
-from collections import OrderedDict
-from datetime import datetime, timedelta
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 import logging
 import requests
 from urllib.parse import urlencode
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Optional, Tuple
 
-from bson import ObjectId
-from dateutil.rrule import rrule, MONTHLY
+from bson import DBRef, ObjectId, SON
 from flask import current_app
 from pymongo.command_cursor import CommandCursor
 from mongoengine import QuerySet
+from udata.models import Dataset, Follow, Organization, Reuse
+
+from udata_metrics import client, get_config, profiling
+from udata_metrics.models import MetricsSeries
+from udata_metrics.series import MonthSeries, months_from, months_window
 
 
 log = logging.getLogger(__name__)
 
+DATASET_TRAFFIC_LABELS = ['visit', 'download_resource']
+REUSE_TRAFFIC_LABELS = ['visit']
+ORGANIZATION_TRAFFIC_LABELS = ['visit_dataset', 'download_resource', 'visit_reuse']
+SITE_TRAFFIC_LABELS = ['visit_dataset', 'download_resource']
+
+# Monthly traffic metrics labels by model
+TRAFFIC_LABELS = {
+    'dataset': DATASET_TRAFFIC_LABELS,
+    'reuse': REUSE_TRAFFIC_LABELS,
+    'organization': ORGANIZATION_TRAFFIC_LABELS,
+    'site': SITE_TRAFFIC_LABELS,
+}
+
+
+class FallbackSeries(list):
+    '''
+    Series of an object served instead of the metrics API ones when it fails,
+    mirrored or empty
+    '''
+
 
-def get_last_13_months() -> List[str]:
-    dstart = datetime.today().replace(day=1) - timedelta(days=365)
-    months = rrule(freq=MONTHLY, count=13, dtstart=dstart)
-    return [month.strftime('%Y-%m') for month in months]
+def get_last_13_months() -> Tuple[str, ...]:
+    return months_window(date.today())
 
 
-def compute_monthly_metrics(metrics_data: List[Dict], metrics_labels: List[str]) -> OrderedDict:
-    # Initialize default monthly_metrics
-    monthly_metrics = OrderedDict(
-        (month, {label: 0 for label in metrics_labels}) for month in get_last_13_months()
-    )
-    # Update monthly_metrics with metrics_data values
+def compute_monthly_metrics(metrics_data: List[Dict],
+                            metrics_labels: List[str]) -> Dict[str, MonthSeries]:
+    months = get_last_13_months()
+    index = {month: i for i, month in enumerate(months)}
+    # Initialize default monthly values by label
+    columns = {label: [0] * len(months) for label in metrics_labels}
+    # Update monthly values with metrics_data values
     for entry in metrics_data:
-        entry_month = entry['metric_month']
-        if entry_month in monthly_metrics:
+        i = index.get(entry['metric_month'])
+        if i is not None:
             for metric_label in metrics_labels:
-                label = f'monthly_{metric_label}'
-                monthly_metrics[entry_month][metric_label] = entry.get(label) or 0
-    return monthly_metrics
+                columns[metric_label][i] = int(entry.get(f'monthly_{metric_label}') or 0)
+    return {label: MonthSeries(months, values) for label, values in columns.items()}
+
+
+def metrics_by_label(monthly_metrics: Dict[str, MonthSeries],
+                     metrics_labels: List[str]) -> List[MonthSeries]:
+    return [monthly_metrics[label] for label in metrics_labels]
+
+
+def get_monthly_params(metrics_labels: List[str], *columns: str) -> Dict[str, str]:
+    '''
+    Query params restricting monthly metrics to the displayed months
+    and to the columns needed for `metrics_labels`
+    '''
+    return {
+        'metric_month__sort': 'desc',
+        'metric_month__greater': get_last_13_months()[0],
+        'columns': ','.join([
+            'metric_month', *columns, *(f'monthly_{label}' for label in metrics_labels)
+        ]),
+    }
 
 
-def metrics_by_label(monthly_metrics: Dict, metrics_labels: List[str]) -> List[OrderedDict]:
-    metrics_by_label = []
-    for label in metrics_labels:
-        metrics_by_label.append(
-            OrderedDict((month, monthly_metrics[month][label]) for month in monthly_metrics))
-    return metrics_by_label
+def fetch_metrics_data(url: str, params: Dict) -> List[Dict]:
+    '''Get the rows of all pages of a metrics API query'''
+    res = client.get(url, params, view=True)
+    data = res.json()
+    rows = data['data']
+    while next_url := data.get('links', {}).get('next'):
+        data = client.get(next_url, view=True).json()
+        rows += data['data']
+    return rows
+
+
+def log_api_error(target: str, error: requests.exceptions.RequestException) -> None:
+    if isinstance(error, client.CircuitOpenError):
+        log.warning(f'Metrics API is down, serving last known metrics for {target}')
+    else:
+        log.exception(f'Error while getting metrics for {target}: {error}')
+
+
+def get_stored_series(
+            model: str,
+            ids: List[Optional[str]],
+            metrics_labels: List[str]
+        ) -> Tuple[Dict[Optional[str], List[MonthSeries]], Dict[Optional[str], List[MonthSeries]]]:
+    '''
+    Get the monthly metrics of the objects having all `metrics_labels` from their mirror
+    in a single query, by id, as the fresh ones of the current months window
+    updated less than `METRICS_SERIES_MAX_AGE` seconds ago, and all of them
+    to be served if the metrics API goes down.
+    '''
+    months = get_last_13_months()
+    fresh_after = datetime.utcnow() - timedelta(seconds=get_config('METRICS_SERIES_MAX_AGE'))
+    fresh, stored = {}, {}
+    for series in MetricsSeries.objects(model=model, object_id__in=ids):
+        if not all(label in series.series for label in metrics_labels):
+            continue
+        if series.start == months[0]:
+            stored[series.object_id] = [
+                MonthSeries(months, series.series[label]) for label in metrics_labels
+            ]
+            if series.updated_at > fresh_after:
+                fresh[series.object_id] = stored[series.object_id]
+        else:
+            stored_months = months_from(series.start)
+            stored[series.object_id] = [
+                MonthSeries.from_counts(months, dict(zip(stored_months, series.series[label])))
+                for label in metrics_labels
+            ]
+    return fresh, stored
 
 
 def get_metrics_for_model(
             model: str,
             id: Union[str, ObjectId, None],
             metrics_labels: List[str]
-        ) -> List[OrderedDict]:
+        ) -> List[MonthSeries]:
     '''
-    Get distant metrics for a particular model object
+    Get distant metrics for a particular model object, from their local mirror if fresh,
+    or from the metrics API, falling back on the last mirrored ones if it fails
     '''
     if not current_app.config['METRICS_API']:
         # TODO: How to best deal with no METRICS_API, prevent calling or return empty?
         # raise ValueError("missing config METRICS_API to use this function")
         return [{} for _ in range(len(metrics_labels))]
+    object_id = str(id) if id else None
+    fresh, stored = get_stored_series(model, [object_id], metrics_labels)
+    if object_id in fresh:
+        return fresh[object_id]
     models = model + 's' if id else model  # TODO: not clean of a hack
     model_metrics_api = f'{current_app.config["METRICS_API"]}/{models}/data/'
     try:
-        params = {
-            'metric_month__sort': 'desc'
-        }
+        params = get_monthly_params(metrics_labels)
         if id:
             params[f'{model}_id__exact'] = id
-        res = requests.get(model_metrics_api, params)
-        res.raise_for_status()
-        monthly_metrics = compute_monthly_metrics(res.json()['data'], metrics_labels)
+        monthly_metrics = compute_monthly_metrics(
+            fetch_metrics_data(model_metrics_api, params), metrics_labels)
         return metrics_by_label(monthly_metrics, metrics_labels)
     except requests.exceptions.RequestException as e:
-        log.exception(f'Error while getting metrics for {model}({id}): {e}')
-        return [{} for _ in range(len(metrics_labels))]
+        log_api_error(f'{model}({id})', e)
+        return FallbackSeries(stored.get(object_id, [{} for _ in range(len(metrics_labels))]))
+
+
+def get_metrics_for_models(
+            model: str,
+            ids: List[Union[str, ObjectId]],
+            metrics_labels: List[str]
+        ) -> Dict[str, List[MonthSeries]]:
+    '''
+    Get distant metrics for several objects of a model, by string id,
+    from their local mirror if fresh, or with a single page `{model}_id__in` request
+    for each chunk of `METRICS_API_BATCH_SIZE` missing ids, falling back on the last mirrored
+    ones of the chunks for which the metrics API fails
+    '''
+    ids = [str(id) for id in ids]
+    if not current_app.config['METRICS_API']:
+        return {id: [{} for _ in range(len(metrics_labels))] for id in ids}
+    metrics, stored = get_stored_series(model, ids, metrics_labels)
+    missing = [id for id in ids if id not in metrics]
+    model_metrics_api = f'{current_app.config["METRICS_API"]}/{model}s/data/'
+    batch_size = get_config('METRICS_API_BATCH_SIZE')
+    for i in range(0, len(missing), batch_size):
+        chunk = missing[i:i + batch_size]
+        try:
+            params = {
+                **get_monthly_params(metrics_labels, f'{model}_id'),
+                f'{model}_id__in': ','.join(chunk),
+                # All the chunk rows in a single page
+                'page_size': len(chunk) * len(get_last_13_months()),
+            }
+            rows_by_id = defaultdict(list)
+            for row in fetch_metrics_data(model_metrics_api, params):
+                rows_by_id[row[f'{model}_id']].append(row)
+            chunk_metrics = {
+                id: metrics_by_label(
+                    compute_monthly_metrics(rows_by_id[id], metrics_labels), metrics_labels)
+                for id in chunk
+            }
+        except requests.exceptions.RequestException as e:
+            log_api_error(f'{model}({", ".join(chunk)})', e)
+            metrics.update({
+                id: FallbackSeries(stored.get(id, [{} for _ in range(len(metrics_labels))]))
+                for id in chunk
+            })
+            continue
+        metrics.update(chunk_metrics)
+    return metrics
 
 
 def get_download_url(model: str, id: Union[str, ObjectId, None]) -> str:
@@ -82,21 +213,19 @@ def get_download_url(model: str, id: Union[str, ObjectId, None]) -> str:
     return f'{base_url}?{urlencode(args)}'
 
 
-def compute_monthly_aggregated_metrics(aggregation_res: CommandCursor) -> OrderedDict:
-    monthly_metrics = OrderedDict((month, 0) for month in get_last_13_months())
+def compute_monthly_aggregated_metrics(aggregation_res: CommandCursor) -> MonthSeries:
+    counts = {}
     for monthly_count in aggregation_res:
         year, month = monthly_count['_id'].split('-')
-        monthly_label = year + '-' + month.zfill(2)
-        if monthly_label in monthly_metrics:
-            monthly_metrics[monthly_label] = monthly_count['count']
-    return monthly_metrics
+        counts[year + '-' + month.zfill(2)] = monthly_count['count']
+    return MonthSeries.from_counts(get_last_13_months(), counts)
 
 
-def get_stock_metrics(objects: QuerySet, date_label: str = 'created_at') -> OrderedDict:
+def stock_metrics_stages(date_label: str = 'created_at') -> List[Dict]:
     '''
-    Get stock metrics for a particular model object
+    Aggregation stages counting documents by month of `date_label` over the last year
     '''
-    pipeline = [
+    return [
         {
             '$match': {
                 date_label: {'$gte': datetime.now() - timedelta(days=365)}
@@ -113,6 +242,87 @@ def get_stock_metrics(objects: QuerySet, date_label: str = 'created_at') -> Orde
             }
         }
     ]
-    aggregation_res = objects.aggregate(*pipeline)
 
-    return compute_monthly_aggregated_metrics(aggregation_res)
+
+def get_stock_metrics(objects: QuerySet, date_label: str = 'created_at') -> MonthSeries:
+    '''
+    Get stock metrics for a particular model object
+    '''
+    with profiling.timing('metrics-stock', objects._document._get_collection_name()):
+        aggregation_res = objects.aggregate(stock_metrics_stages(date_label))
+        return compute_monthly_aggregated_metrics(aggregation_res)
+
+
+def get_stock_metrics_series(
+            objects: QuerySet,
+            series: Dict[str, Tuple[str, List[Dict], str]]
+        ) -> Dict[str, MonthSeries]:
+    '''
+    Get several stock metrics series in a single aggregation round-trip.
+    `series` maps each series name to a `(collection, pipeline, date_label)` tuple:
+    the pipeline selects the documents to count in the collection, and is run
+    as an uncorrelated `$lookup` from the first document of `objects`,
+    so that the joins happen on the database side.
+    Series are zeroes if `objects` is empty.
+    '''
+    pipeline = [{'$limit': 1}]
+    for name, (collection, stages, date_label) in series.items():
+        pipeline.append({
+            '$lookup': {
+                'from': collection,
+                'pipeline': [*stages, *stock_metrics_stages(date_label)],
+                'as': name,
+            }
+        })
+    pipeline.append({'$project': {name: 1 for name in series}})
+    with profiling.timing('metrics-stock', ' '.join(series)):
+        result = next(objects.aggregate(pipeline), {})
+    return {
+        name: compute_monthly_aggregated_metrics(result.get(name, []))
+        for name in series
+    }
+
+
+def following_in(model: type, ids: List[ObjectId]) -> Dict:
+    '''
+    Match the follows of `model` objects by `ids`, on the indexed `following` field
+    stored as a `{_cls, _ref}` subdocument
+    '''
+    collection = model._get_collection_name()
+    return {'following': {'$in': [
+        SON([('_cls', model._class_name), ('_ref', DBRef(collection, id))]) for id in ids
+    ]}}
+
+
+def get_organization_stock_metrics(
+            organization_id: Union[str, ObjectId]
+        ) -> Dict[str, MonthSeries]:
+    '''
+    Get an organization stock metrics series in a single aggregation,
+    from its datasets and reuses ids looked up on their indexed organization.
+    Follows are matched on their indexed `following` field, and the reuses
+    of the organization datasets with a single `$in` query.
+    '''
+    organization_id = ObjectId(organization_id)
+    dataset_ids = Dataset.objects(organization=organization_id).distinct('id')
+    reuse_ids = Reuse.objects(organization=organization_id).distinct('id')
+    visible_reuses = Reuse.objects.visible()._query
+
+    return get_stock_metrics_series(Organization.objects(id=organization_id), {
+        'dataset_metrics': (Dataset._get_collection_name(), [
+            {'$match': Dataset.objects(organization=organization_id).visible()._query},
+        ], 'created_at_internal'),
+        'reuse_metrics': (Reuse._get_collection_name(), [
+            {'$match': Reuse.objects(organization=organization_id).visible()._query},
+        ], 'created_at'),
+        'dataset_follower_metrics': (Follow._get_collection_name(), [
+            {'$match': following_in(Dataset, dataset_ids)},
+        ], 'since'),
+        'reuse_follower_metrics': (Follow._get_collection_name(), [
+            {'$match': following_in(Reuse, reuse_ids)},
+        ], 'since'),
+        # A reuse of several of the organization datasets is matched once
+        'dataset_reuse_metrics': (Reuse._get_collection_name(), [
+            {'$match': {**visible_reuses, 'datasets': {'$in': dataset_ids}}},
+        ], 'created_at'),
+    })
@@ -0,0 +1,80 @@
+from udata.models import db
+
+
+class MetricsSnapshot(db.Document):
+    '''
+    Last metrics values pushed by the update-metrics job for an object
+    '''
+    model = db.StringField(required=True)
+    object_id = db.StringField(required=True)
+    values = db.ListField(db.IntField())
+
+    meta = {
+        'collection': 'metrics_snapshot',
+        'indexes': [
+            {'fields': ['model', 'object_id'], 'unique': True},
+        ],
+    }
+
+
+class MetricsCheckpoint(db.Document):
+    '''
+    Position of the update-metrics job in a metrics API target for a value key
+    '''
+    target = db.StringField(required=True)
+    value_key = db.StringField(required=True)
+    # URL of the page to resume from, `None` once the value key has been fully processed
+    url = db.StringField()
+    updated_at = db.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'metrics_checkpoint',
+        'indexes': [
+            {'fields': ['target', 'value_key'], 'unique': True},
+        ],
+    }
+
+
+class MetricsRollup(db.Document):
+    '''
+    Monthly counts of a stock metrics series for a scope,
+    maintained by the update-metrics-rollups job
+    '''
+    # One of `site`, `organization`, `dataset` or `reuse`
+    scope = db.StringField(required=True)
+    # Id of the scope object, `None` for the site
+    scope_id = db.StringField()
+    series = db.StringField(required=True)
+    # Count by `YYYY-MM` month
+    counts = db.DictField()
+    updated_at = db.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'metrics_rollup',
+        'indexes': [
+            {'fields': ['scope', 'scope_id', 'series'], 'unique': True},
+            ('scope', 'series', 'updated_at'),
+        ],
+    }
+
+
+class MetricsSeries(db.Document):
+    '''
+    Monthly metrics of an object, mirrored from the metrics API by the update-metrics job,
+    and served when the metrics API is down
+    '''
+    model = db.StringField(required=True)
+    # `None` for the site
+    object_id = db.StringField()
+    # First `YYYY-MM` month of the values
+    start = db.StringField(required=True)
+    # Values of the 13 months from `start` by label
+    series = db.DictField()
+    updated_at = db.DateTimeField(required=True)
+
+    meta = {
+        'collection': 'metrics_series',
+        'indexes': [
+            {'fields': ['model', 'object_id'], 'unique': True},
+        ],
+    }
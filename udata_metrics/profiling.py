@@ -0,0 +1,107 @@
+'''
+Sampled profiling of the metrics computations and rendering of a request,
+reported in a `Server-Timing` response header
+'''
+from contextlib import contextmanager
+import logging
+import random
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from flask import Response, g, has_app_context, request
+
+from udata_metrics import get_config
+
+
+log = logging.getLogger(__name__)
+
+
+class Profile(object):
+    '''
+    Timings (in milliseconds) and events of a request metrics computations.
+    They can be recorded from the executor threads computing the metrics parts.
+    '''
+
+    def __init__(self):
+        self.timings: List[Tuple[str, Optional[float], Optional[str]]] = []
+        self.lock = threading.Lock()
+
+    def add(self, name: str, duration: Optional[float] = None, desc: Optional[str] = None) -> None:
+        with self.lock:
+            self.timings.append((name, duration, desc))
+
+    def server_timing(self) -> str:
+        '''Format the timings as a `Server-Timing` header value'''
+        metrics = []
+        for name, duration, desc in self.timings:
+            metric = name
+            if duration is not None:
+                metric += f';dur={duration:.1f}'
+            if desc:
+                metric += f';desc="{desc}"'
+            metrics.append(metric)
+        return ', '.join(metrics)
+
+    def as_list(self) -> List[Dict]:
+        return [{'name': name, 'duration': duration, 'desc': desc}
+                for name, duration, desc in self.timings]
+
+
+def get_profile() -> Optional[Profile]:
+    '''Get the profile of the current request, `None` if it is not sampled'''
+    if not has_app_context():
+        return None
+    return g.get('metrics_profile')
+
+
+def use(profile: Optional[Profile]) -> None:
+    '''Record the timings of the current app context in a request `profile`'''
+    if profile is not None:
+        g.metrics_profile = profile
+
+
+def record(name: str, desc: Optional[str] = None) -> None:
+    '''Record an event without duration, like a cache hit'''
+    profile = get_profile()
+    if profile is not None:
+        profile.add(name, desc=desc)
+
+
+@contextmanager
+def timing(name: str, desc: Optional[str] = None) -> Iterator[None]:
+    '''Record the block duration if the request is sampled'''
+    profile = get_profile()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, (time.perf_counter() - start) * 1000, desc)
+
+
+def start_request() -> None:
+    '''Sample the request, profiling `METRICS_PROFILING_SAMPLE_RATE` of them'''
+    sample_rate = get_config('METRICS_PROFILING_SAMPLE_RATE')
+    if sample_rate and random.random() < sample_rate:
+        g.metrics_profile = Profile()
+
+
+def report(response: Response) -> Response:
+    '''
+    Add the sampled request timings to its `Server-Timing` header,
+    and log them if `METRICS_PROFILING_LOG` is set
+    '''
+    profile = get_profile()
+    if profile is None or not profile.timings:
+        return response
+    server_timing = profile.server_timing()
+    if 'Server-Timing' in response.headers:
+        server_timing = f'{response.headers["Server-Timing"]}, {server_timing}'
+    response.headers['Server-Timing'] = server_timing
+    if get_config('METRICS_PROFILING_LOG'):
+        log.info(f'Metrics timings of {request.path}: {profile.server_timing()}',
+                 extra={'path': request.path, 'metrics_timings': profile.as_list()})
+    return response
@@ -0,0 +1,189 @@
+'''
+Pre-aggregated monthly stock metrics by scope
+'''
+from collections import defaultdict
+from datetime import datetime
+import logging
+from typing import Dict, List, Optional, Union
+
+from bson import ObjectId
+from pymongo import UpdateOne
+from udata.harvest.models import HarvestSource
+from udata.models import db, Dataset, Discussion, Follow, Organization, Reuse, User
+
+from udata_metrics import profiling
+from udata_metrics.metrics import compute_monthly_aggregated_metrics, get_last_13_months
+from udata_metrics.models import MetricsRollup
+from udata_metrics.series import MonthSeries
+
+
+log = logging.getLogger(__name__)
+
+
+def site_stages(objects: db.BaseQuerySet, date_label: str) -> List[Dict]:
+    return [
+        {'$match': objects._query},
+        {'$project': {'scope_id': {'$literal': None}, 'date': f'${date_label}'}},
+    ]
+
+
+def followers_stages(model: type, scope_field: Optional[str] = None) -> List[Dict]:
+    '''
+    Follows of a `model` objects, scoped by the followed object
+    or by its `scope_field` reference
+    '''
+    if scope_field is None:
+        return [
+            {'$match': {'following._cls': model._class_name}},
+            {'$project': {'scope_id': '$following._ref.$id', 'date': '$since'}},
+        ]
+    return [
+        {'$match': {'following._cls': model._class_name}},
+        {'$lookup': {'from': model._get_collection_name(), 'localField': 'following._ref.$id',
+                     'foreignField': '_id', 'as': 'following'}},
+        {'$unwind': '$following'},
+        {'$match': {f'following.{scope_field}': {'$ne': None}}},
+        {'$project': {'scope_id': f'$following.{scope_field}', 'date': '$since'}},
+    ]
+
+
+def rollups():
+    '''
+    Series of each scope, as `(model, date_label, stages)` tuples:
+    the stages select the `model` documents created since the window start
+    and project them to their `scope_id` and `date`.
+    '''
+    visible_reuses = Reuse.objects.visible()._query
+    return {
+        'site': {
+            'user_metrics': (User, 'created_at', site_stages(User.objects, 'created_at')),
+            'dataset_metrics': (Dataset, 'created_at_internal', site_stages(
+                Dataset.objects.visible(), 'created_at_internal')),
+            'harvest_metrics': (HarvestSource, 'created_at', site_stages(
+                HarvestSource.objects, 'created_at')),
+            'reuse_metrics': (Reuse, 'created_at', site_stages(
+                Reuse.objects.visible(), 'created_at')),
+            'organization_metrics': (Organization, 'created_at', site_stages(
+                Organization.objects.visible(), 'created_at')),
+            'discussion_metrics': (Discussion, 'created', site_stages(
+                Discussion.objects, 'created')),
+        },
+        'organization': {
+            'dataset_metrics': (Dataset, 'created_at_internal', [
+                {'$match': {**Dataset.objects.visible()._query, 'organization': {'$ne': None}}},
+                {'$project': {'scope_id': '$organization', 'date': '$created_at_internal'}},
+            ]),
+            'reuse_metrics': (Reuse, 'created_at', [
+                {'$match': {**visible_reuses, 'organization': {'$ne': None}}},
+                {'$project': {'scope_id': '$organization', 'date': '$created_at'}},
+            ]),
+            'dataset_follower_metrics': (Follow, 'since', followers_stages(
+                Dataset, 'organization')),
+            'reuse_follower_metrics': (Follow, 'since', followers_stages(
+                Reuse, 'organization')),
+            'dataset_reuse_metrics': (Reuse, 'created_at', [
+                {'$match': visible_reuses},
+                {'$unwind': '$datasets'},
+                {'$lookup': {'from': Dataset._get_collection_name(), 'localField': 'datasets',
+                             'foreignField': '_id', 'as': 'dataset'}},
+                {'$unwind': '$dataset'},
+                {'$match': {'dataset.organization': {'$ne': None}}},
+                # A reuse of several of the organization datasets is counted once
+                {'$group': {'_id': {'reuse': '$_id', 'scope_id': '$dataset.organization'},
+                            'date': {'$first': '$created_at'}}},
+                {'$project': {'scope_id': '$_id.scope_id', 'date': 1}},
+            ]),
+        },
+        'dataset': {
+            'reuses_metrics': (Reuse, 'created_at', [
+                {'$match': visible_reuses},
+                {'$unwind': '$datasets'},
+                {'$project': {'scope_id': '$datasets', 'date': '$created_at'}},
+            ]),
+            'followers_metrics': (Follow, 'since', followers_stages(Dataset)),
+        },
+        'reuse': {
+            'followers_metrics': (Follow, 'since', followers_stages(Reuse)),
+        },
+    }
+
+
+def update_rollup(scope: str, series: str, model: type, date_label: str,
+                  stages: List[Dict], months: List[str]) -> int:
+    '''
+    Recompute the `months` counts of a scope series.
+    All the `months` counts of the scopes with documents are set, to 0 for the months
+    without documents, and the ones of the scopes without documents are removed.
+    '''
+    start = datetime.utcnow()
+    pipeline = [
+        {'$match': {date_label: {'$gte': datetime.strptime(months[0], '%Y-%m')}}},
+        *stages,
+        {'$group': {
+            '_id': {
+                'scope_id': '$scope_id',
+                'month': {'$dateToString': {'format': '%Y-%m', 'date': '$date'}},
+            },
+            'count': {'$sum': 1},
+        }},
+    ]
+    counts = defaultdict(dict)
+    for result in model.objects.aggregate(pipeline):
+        scope_id, month = result['_id']['scope_id'], result['_id']['month']
+        if month in months:
+            counts[str(scope_id) if scope_id else None][month] = result['count']
+    requests = [
+        UpdateOne(
+            {'scope': scope, 'scope_id': scope_id, 'series': series},
+            {'$set': {
+                **{f'counts.{month}': scope_counts.get(month, 0) for month in months},
+                'updated_at': start,
+            }},
+            upsert=True,
+        )
+        for scope_id, scope_counts in counts.items()
+    ]
+    collection = MetricsRollup._get_collection()
+    if requests:
+        collection.bulk_write(requests, ordered=False)
+    collection.update_many(
+        {'scope': scope, 'series': series, 'updated_at': {'$lt': start}},
+        {'$unset': {f'counts.{month}': '' for month in months}},
+    )
+    return len(requests)
+
+
+def update_rollups(full: bool = False) -> None:
+    '''
+    Update the stock metrics rollups, recomputing the current and the previous month,
+    or the whole displayed window on `full` update or for a series never computed before.
+    Older months are not recomputed: objects deleted or hidden afterwards are still counted.
+    '''
+    months = get_last_13_months()
+    for scope, scope_rollups in rollups().items():
+        for series, (model, date_label, stages) in scope_rollups.items():
+            if full or not MetricsRollup.objects(scope=scope, series=series).first():
+                series_months = months
+            else:
+                series_months = months[-2:]
+            count = update_rollup(scope, series, model, date_label, stages, series_months)
+            log.info(f'Updated {count} {scope} {series} rollups')
+
+
+def get_rollup_metrics(scope: str,
+                       scope_id: Union[str, ObjectId, None] = None) -> Dict[str, MonthSeries]:
+    '''
+    Get the stock metrics series of a scope from its rollups, in a single lookup
+    '''
+    with profiling.timing('metrics-stock', f'{scope} rollups'):
+        counts = {
+            rollup.series: rollup.counts
+            for rollup in MetricsRollup.objects(scope=scope,
+                                                scope_id=str(scope_id) if scope_id else None)
+        }
+    return {
+        series: compute_monthly_aggregated_metrics(
+            {'_id': month, 'count': count} for month, count in counts.get(series, {}).items()
+        )
+        for series in rollups()[scope]
+    }
@@ -0,0 +1,72 @@
+'''
+Compact monthly metrics series
+'''
+from array import array
+from collections.abc import Mapping
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, Tuple
+
+from dateutil.rrule import rrule, MONTHLY
+
+
+@lru_cache(maxsize=2)
+def months_window(today: date) -> Tuple[str, ...]:
+    '''The 13 `YYYY-MM` months up to `today` one, computed once per day'''
+    dstart = today.replace(day=1) - timedelta(days=365)
+    months = rrule(freq=MONTHLY, count=13, dtstart=dstart)
+    return tuple(month.strftime('%Y-%m') for month in months)
+
+
+@lru_cache(maxsize=16)
+def months_from(start: str) -> Tuple[str, ...]:
+    '''The 13 months window starting on `start` month, shared by the series using it'''
+    year, month = (int(part) for part in start.split('-'))
+    return tuple(
+        f'{year + (month - 1 + i) // 12}-{(month - 1 + i) % 12 + 1:02}' for i in range(13)
+    )
+
+
+class MonthSeries(Mapping):
+    '''
+    Read-only mapping of `YYYY-MM` months to values, as an array of values
+    sharing its months window with the other series.
+    It keeps the `OrderedDict` interface used by the templates,
+    is pickled as its start month and values and JSON encoded with `to_dict`.
+    '''
+    __slots__ = ('months', 'array')
+
+    def __init__(self, months: Tuple[str, ...], values: Iterable[int] = ()):
+        self.months = months
+        self.array = array('q', values)
+        if not self.array:
+            self.array = array('q', bytes(8 * len(months)))
+
+    @classmethod
+    def from_counts(cls, months: Tuple[str, ...], counts: Dict[str, int]) -> 'MonthSeries':
+        return cls(months, (counts.get(month) or 0 for month in months))
+
+    def __getitem__(self, month: str) -> int:
+        try:
+            return self.array[self.months.index(month)]
+        except ValueError:
+            raise KeyError(month)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.months)
+
+    def __len__(self) -> int:
+        return len(self.months)
+
+    def __reduce__(self):
+        return unpickle, (self.months[0], self.array.tolist())
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(zip(self.months, self.array))
+
+    def __repr__(self) -> str:
+        return f'MonthSeries({self.to_dict()!r})'
+
+
+def unpickle(start: str, values: Iterable[int]) -> MonthSeries:
+    return MonthSeries(months_from(start), values)
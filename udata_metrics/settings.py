@@ -4,3 +4,101 @@ Default settings for udata-metrics
 
 # Metrics PostgREST API
 METRICS_API = None
+
+# Number of updates sent in a single `bulk_write` by the update-metrics job
+METRICS_BULK_BATCH_SIZE = 1000
+
+# Write concern used for the update-metrics job bulk writes
+METRICS_BULK_WRITE_CONCERN = {'w': 1}
+
+# Number of metrics API pages fetched concurrently by the update-metrics job (1 is sequential)
+METRICS_API_CONCURRENCY = 1
+
+# Only write metrics that changed since the last update-metrics run
+METRICS_INCREMENTAL_UPDATE = True
+
+# Run the update-metrics job steps in parallel as a Celery chord instead of sequentially
+METRICS_UPDATE_PARALLEL = False
+
+# Delay (in seconds) after which an interrupted update-metrics job restarts from scratch
+METRICS_CHECKPOINT_EXPIRATION = 6 * 60 * 60
+
+# Metrics API HTTP client connections pool size, timeouts (in seconds) and retries on errors
+# of the jobs, and timeouts and retries of the requests made to render views
+METRICS_API_POOL_SIZE = 10
+METRICS_API_CONNECT_TIMEOUT = 3
+METRICS_API_READ_TIMEOUT = 10
+METRICS_API_RETRIES = 3
+METRICS_API_RETRY_BACKOFF = 0.5
+METRICS_API_VIEW_CONNECT_TIMEOUT = 1
+METRICS_API_VIEW_READ_TIMEOUT = 3
+METRICS_API_VIEW_RETRIES = 0
+
+# Stream update-metrics job rows from the metrics API CSV exports instead of paginated JSON
+METRICS_SYNC_FROM_CSV = False
+
+# Number of chunks of rows fetched ahead of the update-metrics job writes (0 disables pipelining)
+METRICS_SYNC_QUEUE_SIZE = 20
+
+# Path of a file where to export update-metrics job stats in Prometheus text format
+METRICS_SYNC_PROMETHEUS_FILE = None
+
+# Maximum number of objects ids in a single metrics API batch lookup
+METRICS_API_BATCH_SIZE = 50
+
+# View metrics cache durations (in seconds): entries are fresh until the soft TTL,
+# then served while being refreshed until the hard TTL.
+# The update-metrics job invalidates the entries of the objects it updates,
+# but nothing invalidates them on new follows, reuses or datasets: unless the stock series
+# are read from the rollups (`METRICS_STOCK_ROLLUPS`), entries are only fresh
+# for the live stock TTL.
+METRICS_CACHE_SOFT_TTL = 24 * 60 * 60
+METRICS_CACHE_HARD_TTL = 7 * 24 * 60 * 60
+METRICS_CACHE_LIVE_STOCK_TTL = 60 * 60
+
+# Duration (in seconds) during which view metrics missing some series, because their computation
+# failed or exceeded `METRICS_COMPUTE_DEADLINE`, are fresh before being refreshed
+METRICS_CACHE_DEGRADED_TTL = 5 * 60
+
+# Maximum duration (in seconds) of a view metrics computation lock,
+# and of the wait for another worker computing the same missing entry
+METRICS_CACHE_LOCK_TIMEOUT = 30
+METRICS_CACHE_WAIT = 5
+
+# Refresh stale view metrics in a Celery task instead of a background thread
+METRICS_CACHE_ASYNC_REFRESH = False
+
+# Number of most visited datasets, reuses and organizations
+# whose view metrics are precomputed by the warm-metrics-cache job
+METRICS_CACHE_WARM_COUNT = 1000
+
+# Read the stock metrics from the monthly rollups maintained by the update-metrics-rollups job
+# instead of aggregating them on each computation
+METRICS_STOCK_ROLLUPS = False
+
+# Number of threads computing the traffic and stock parts of view metrics concurrently
+# (0 to compute them sequentially, parts finding no free thread are computed inline),
+# and deadline (in seconds) after which unfinished parts are replaced by empty series
+METRICS_COMPUTE_WORKERS = 8
+METRICS_COMPUTE_DEADLINE = 10
+
+# Consecutive metrics API failures after which requests fail fast,
+# and interval (in seconds) between the background probes of the metrics API recovery
+METRICS_API_BREAKER_THRESHOLD = 5
+METRICS_API_BREAKER_RESET = 30
+
+# Render a placeholder linking to the metrics JSON endpoint in the template hooks
+# while uncached metrics are computed in background, instead of computing them inline
+METRICS_HOOKS_PLACEHOLDER = False
+
+# Mirror the monthly metrics series of objects in the `metrics_series` collection
+# in update-metrics job, and age (in seconds) after which mirrored series are fetched
+# from the metrics API again
+METRICS_SYNC_MONTHLY_SERIES = True
+METRICS_SERIES_MAX_AGE = 2 * 24 * 60 * 60
+
+# Fraction of the requests whose metrics cache lookups, metrics API calls, stock aggregations
+# and rendering are timed (0 disables profiling), reported in a `Server-Timing` response header,
+# and logged with a `metrics_timings` extra field if `METRICS_PROFILING_LOG` is set
+METRICS_PROFILING_SAMPLE_RATE = 0
+METRICS_PROFILING_LOG = False
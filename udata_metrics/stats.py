@@ -0,0 +1,104 @@
+'''
+Throughput instrumentation of the update-metrics job
+'''
+from bisect import bisect_left
+from contextlib import contextmanager
+import threading
+import time
+from typing import Dict, Iterator, Tuple
+
+# Upper bounds (in seconds) of the latency histograms buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PROMETHEUS_PREFIX = 'udata_metrics_sync'
+
+
+class Histogram(object):
+    def __init__(self, buckets: Tuple[float] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        # Last count is for values above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def as_dict(self) -> Dict:
+        '''Buckets counts are cumulative, like in Prometheus histograms'''
+        cumulative, buckets = 0, {}
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        buckets['+Inf'] = self.count
+        return {'count': self.count, 'sum': round(self.sum, 6), 'buckets': buckets}
+
+
+class SyncStats(object):
+    '''
+    Counters and latency histograms of an update-metrics step.
+    They can be updated from the fetching threads.
+    '''
+    COUNTERS = ('pages_fetched', 'rows_fetched', 'writes', 'matched', 'modified',
+                'skipped', 'errors')
+    HISTOGRAMS = ('http_latency', 'write_latency')
+
+    def __init__(self, step: str):
+        self.step = step
+        self.start = time.perf_counter()
+        self.counters = {counter: 0 for counter in self.COUNTERS}
+        self.histograms = {histogram: Histogram() for histogram in self.HISTOGRAMS}
+        self.lock = threading.Lock()
+
+    def incr(self, counter: str, value: int = 1) -> None:
+        with self.lock:
+            self.counters[counter] += value
+
+    @contextmanager
+    def timing(self, histogram: str) -> Iterator[None]:
+        '''Observe the block duration, counting an error if it raises'''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.incr('errors')
+            raise
+        finally:
+            with self.lock:
+                self.histograms[histogram].observe(time.perf_counter() - start)
+
+    def as_dict(self) -> Dict:
+        with self.lock:
+            return {
+                'duration': round(time.perf_counter() - self.start, 6),
+                **self.counters,
+                **{name: histogram.as_dict() for name, histogram in self.histograms.items()},
+            }
+
+
+def to_prometheus(summary: Dict[str, Dict]) -> str:
+    '''
+    Format a summary of `SyncStats.as_dict()` by step
+    in the Prometheus text exposition format.
+    '''
+    lines = []
+    steps = list(summary.items())
+    lines.append(f'# TYPE {PROMETHEUS_PREFIX}_duration_seconds gauge')
+    for step, stats in steps:
+        lines.append(f'{PROMETHEUS_PREFIX}_duration_seconds{{step="{step}"}} {stats["duration"]}')
+    for counter in SyncStats.COUNTERS:
+        lines.append(f'# TYPE {PROMETHEUS_PREFIX}_{counter}_total counter')
+        for step, stats in steps:
+            lines.append(f'{PROMETHEUS_PREFIX}_{counter}_total{{step="{step}"}} {stats[counter]}')
+    for histogram in SyncStats.HISTOGRAMS:
+        name = f'{PROMETHEUS_PREFIX}_{histogram}_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        for step, stats in steps:
+            values = stats[histogram]
+            for bound, count in values['buckets'].items():
+                lines.append(f'{name}_bucket{{step="{step}",le="{bound}"}} {count}')
+            lines.append(f'{name}_sum{{step="{step}"}} {values["sum"]}')
+            lines.append(f'{name}_count{{step="{step}"}} {values["count"]}')
+    return '\n'.join(lines) + '\n'
@@ -1,18 +1,53 @@
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime, timedelta
+from itertools import islice
 import logging
-from typing import Dict, List
-import requests
+import math
+import os
+import queue
+import threading
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse, urlunparse
 from functools import wraps
 import time
 
+from celery import chord
 from flask import current_app
+from mongoengine.errors import ValidationError
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+from pymongo.write_concern import WriteConcern
 
 from udata.core.dataservices.models import Dataservice
+from udata.core.dataset.models import Resource
 from udata.models import db, CommunityResource, Dataset, Reuse, Organization
-from udata.tasks import job
+from udata.app import cache
+from udata.tasks import job, task
+
+from udata_metrics import client, get_config
+from udata_metrics.cache import cache_key, cached_functions, invalidate
+from udata_metrics.metrics import (
+    TRAFFIC_LABELS, compute_monthly_metrics, get_last_13_months, get_monthly_params
+)
+from udata_metrics.models import MetricsCheckpoint, MetricsSeries, MetricsSnapshot
+from udata_metrics.rollups import update_rollups
+from udata_metrics.stats import SyncStats, to_prometheus
 
 
 log = logging.getLogger(__name__)
 
+# Number of rows passed at once from the fetching thread to the writing one
+PIPELINE_CHUNK_SIZE = 100
+
+# Cached view metrics function of each updated model
+CACHED_VIEW_METRICS = {
+    'Dataset': 'get_dataset_metrics',
+    'Reuse': 'get_reuse_metrics',
+    'Organization': 'get_organization_metrics',
+}
+
 
 def log_timing(func):
     @wraps(func)
@@ -30,100 +65,728 @@ def log_timing(func):
     return timeit_wrapper
 
 
-def save_model(model: db.Document, model_id: str, metrics: Dict[str, int]) -> None:
-    try:
-        result = model.objects(id=model_id).update(**{
-            f'set__metrics__{key}': value for key, value in metrics.items()
-        })
+class Snapshot(object):
+    '''
+    Last metrics values pushed for a model, used to only write the changed ones.
+    Values are looked up for a batch of objects at once with `load`,
+    and kept as tuples ordered like the metrics dict given by the caller.
+    '''
+
+    def __init__(self, name: str):
+        self.name = name
+        self.collection = MetricsSnapshot._get_collection()
+        self.values = {}
+        self.updates = []
+
+    def load(self, object_ids: List[str]) -> None:
+        '''Look up the values of a batch of objects, replacing the previous batch ones'''
+        projection = {'_id': 0, 'object_id': 1, 'values': 1}
+        query = {'model': self.name, 'object_id': {'$in': [str(id) for id in set(object_ids)]}}
+        self.values = {
+            doc['object_id']: tuple(doc['values'])
+            for doc in self.collection.find(query, projection)
+        }
+
+    def has_changed(self, object_id: str, metrics: Dict[str, int]) -> bool:
+        return self.values.get(str(object_id)) != tuple(metrics.values())
+
+    def update(self, object_id: str, metrics: Dict[str, int]) -> None:
+        values = tuple(metrics.values())
+        self.values[str(object_id)] = values
+        self.updates.append(UpdateOne(
+            {'model': self.name, 'object_id': str(object_id)},
+            {'$set': {'values': list(values)}},
+            upsert=True
+        ))
+
+    def flush(self) -> None:
+        if self.updates:
+            self.collection.bulk_write(self.updates, ordered=False)
+        self.updates = []
+
+    def discard(self) -> None:
+        self.updates = []
+
+
+class BulkWriter(object):
+    '''
+    Buffer updates on a model collection and flush them
+    as unordered `bulk_write` batches of up to `METRICS_BULK_BATCH_SIZE` operations.
+    If `METRICS_INCREMENTAL_UPDATE` is set, metrics unchanged since the last run are skipped,
+    the snapshots of each batch being looked up when it is flushed.
+    The optional `checkpoint` is committed after each successful flush.
+    Cached view metrics of the updated objects are invalidated after each flush.
+    '''
+
+    def __init__(self, model: db.Document, batch_size: Optional[int] = None,
+                 write_concern: Optional[Dict] = None, checkpoint: Optional['Checkpoint'] = None,
+                 stats: Optional[SyncStats] = None):
+        self.model = model
+        self.checkpoint = checkpoint
+        self.stats = stats or SyncStats(model.__name__)
+        self.batch_size = batch_size or get_config('METRICS_BULK_BATCH_SIZE')
+        if write_concern is None:
+            write_concern = get_config('METRICS_BULK_WRITE_CONCERN')
+        self.collection = model._get_collection().with_options(
+            write_concern=WriteConcern(**write_concern))
+        self.incremental = get_config('METRICS_INCREMENTAL_UPDATE')
+        self.snapshots = {}
+        # Saved metrics, as `(model_id, pk, metrics, resources)` tuples
+        self.pending = []
+        self.cached_view_metrics = CACHED_VIEW_METRICS.get(model.__name__)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        self.flush()
+        if self.checkpoint and exc_type is None:
+            self.checkpoint.commit()
 
-        if result is None:
-            log.debug(f'{model.__name__} not found', extra={
+    def snapshot(self, name: str) -> Snapshot:
+        if name not in self.snapshots:
+            self.snapshots[name] = Snapshot(name)
+        return self.snapshots[name]
+
+    def has_changed(self, name: str, object_id: str, metrics: Dict[str, int]) -> bool:
+        '''Check metrics against the loaded snapshot and record them if they changed'''
+        if not self.incremental:
+            return True
+        snapshot = self.snapshot(name)
+        if not snapshot.has_changed(object_id, metrics):
+            self.stats.incr('skipped')
+            return False
+        snapshot.update(object_id, metrics)
+        return True
+
+    def add(self, model_id: str, pk, metrics: Optional[Dict[str, int]] = None,
+            resources: Optional[Dict[str, Dict[str, int]]] = None) -> None:
+        self.pending.append((model_id, pk, metrics, resources))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def to_mongo(self, model_id: str):
+        try:
+            return self.model._fields['id'].to_mongo(model_id)
+        except ValidationError:
+            log.debug(f'Invalid {self.model.__name__} id', extra={
                 'id': model_id
             })
-    except Exception as e:
-        log.exception(e)
+            return None
+
+    def save(self, model_id: str, metrics: Dict[str, int]) -> None:
+        '''Set the metrics of an object, if they changed'''
+        pk = self.to_mongo(model_id)
+        if pk is not None:
+            self.add(model_id, pk, metrics=metrics)
+
+    def save_resources(self, dataset_id: str, resources: Dict[str, Dict[str, int]]) -> None:
+        '''
+        Update the metrics of several resources of a dataset in a single operation,
+        each resource being targeted with its own `arrayFilters` identifier.
+        '''
+        pk = self.to_mongo(dataset_id)
+        if pk is not None:
+            self.add(dataset_id, pk, resources=resources)
+
+    def load_snapshots(self, pending: List[Tuple]) -> None:
+        model_ids = [model_id for model_id, _, metrics, _ in pending if metrics is not None]
+        resource_ids = [resource_id for _, _, _, resources in pending if resources
+                        for resource_id in resources]
+        if model_ids:
+            self.snapshot(self.model.__name__).load(model_ids)
+        if resource_ids:
+            self.snapshot(Resource.__name__).load(resource_ids)
+
+    def build_operations(self, pending: List[Tuple]) -> Tuple[List[UpdateOne], List[str]]:
+        '''Build the updates of the changed metrics, with the ids of the updated objects'''
+        if self.incremental:
+            self.load_snapshots(pending)
+        operations, updated_ids = [], []
+        for model_id, pk, metrics, resources in pending:
+            if metrics is not None:
+                if not self.has_changed(self.model.__name__, model_id, metrics):
+                    continue
+                operations.append(UpdateOne({'_id': pk}, {'$set': {
+                    f'metrics.{key}': value for key, value in metrics.items()
+                }}))
+            else:
+                resources = {
+                    resource_id: metrics for resource_id, metrics in resources.items()
+                    if self.has_changed(Resource.__name__, resource_id, metrics)
+                }
+                if not resources:
+                    continue
+                operations.append(self.resources_update(pk, resources))
+            updated_ids.append(model_id)
+        return operations, updated_ids
+
+    def resources_update(self, pk, resources: Dict[str, Dict[str, int]]) -> UpdateOne:
+        resource_id_field = Resource._fields['id']
+        update, array_filters = {}, []
+        for i, (resource_id, metrics) in enumerate(resources.items()):
+            for key, value in metrics.items():
+                update[f'resources.$[r{i}].metrics.{key}'] = value
+            array_filters.append({f'r{i}.{resource_id_field.db_field}':
+                                  resource_id_field.to_mongo(resource_id)})
+        return UpdateOne({'_id': pk}, {'$set': update}, array_filters=array_filters)
+
+    def flush(self) -> None:
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        operations, updated_ids = self.build_operations(pending)
+        if not operations:
+            if self.checkpoint:
+                self.checkpoint.commit()
+            return
+        self.stats.incr('writes', len(operations))
+        try:
+            with self.stats.timing('write_latency'):
+                result = self.collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            log.exception(e)
+            # Don't know which writes failed, they will be retried on next run
+            for snapshot in self.snapshots.values():
+                snapshot.discard()
+            matched, modified = e.details['nMatched'], e.details['nModified']
+            # Some of the writes may have succeeded
+            self.invalidate(updated_ids)
+        else:
+            self.invalidate(updated_ids)
+            for snapshot in self.snapshots.values():
+                snapshot.flush()
+            if self.checkpoint:
+                self.checkpoint.commit()
+            if not result.acknowledged:
+                log.info(f'{self.model.__name__}: flushed {len(operations)} '
+                         'unacknowledged updates')
+                return
+            matched, modified = result.matched_count, result.modified_count
+        self.stats.incr('matched', matched)
+        self.stats.incr('modified', modified)
+        log.info(f'{self.model.__name__}: flushed {len(operations)} updates '
+                 f'({matched} matched, {modified} modified)')
+
+    def invalidate(self, ids: List[str]) -> None:
+        if self.cached_view_metrics:
+            invalidate(self.cached_view_metrics, set(ids))
+
+
+class IdBitmap(object):
+    '''
+    Compact set of the non-negative integer `__id` of metrics rows,
+    storing one bit per id instead of a Python object per id.
+    '''
+
+    def __init__(self):
+        self.bits = bytearray()
+
+    def add(self, id: int) -> None:
+        index, bit = divmod(id, 8)
+        if index >= len(self.bits):
+            # Grow at least twofold to amortize reallocations
+            self.bits.extend(bytes(max(index + 1 - len(self.bits), len(self.bits))))
+        self.bits[index] |= 1 << bit
+
+    def __contains__(self, id: int) -> bool:
+        index, bit = divmod(id, 8)
+        return index < len(self.bits) and bool(self.bits[index] & (1 << bit))
+
+
+def fetch_page(url: str, stats: SyncStats) -> dict:
+    with stats.timing('http_latency'):
+        data = client.get(url).json()
+    stats.incr('pages_fetched')
+    return data
+
+
+def iterate_on_pages(url: str, stats: SyncStats) -> Iterator[Tuple[str, dict]]:
+    '''Yield pages URL and data one after another following the `links.next` URLs'''
+    while url is not None:
+        data = fetch_page(url, stats)
+        yield url, data
+        url = data['links'].get('next')
+
+
+def iterate_on_pages_concurrently(url: str, page_size: int, concurrency: int,
+                                  stats: SyncStats) -> Iterator[Tuple[str, dict]]:
+    '''
+    Yield pages URL and data in order, planning the pages list from the first page
+    `meta.total` and fetching them through a thread pool of `concurrency` workers.
+    At most `2 * concurrency` pages are fetched ahead of the consumer.
+    '''
+    parsed = urlparse(url)
+    params = parse_qsl(parsed.query)
+    start = int(dict(params).get('page', 1))
+    url = urlunparse(parsed._replace(query=urlencode([(k, v) for k, v in params if k != 'page'])))
+
+    def page_url(page: int) -> str:
+        return url if page == 1 else f'{url}&page={page}'
+
+    app = current_app._get_current_object()
+
+    def fetch_page_in_context(url: str) -> dict:
+        with app.app_context():
+            return fetch_page(url, stats)
+
+    data = fetch_page(page_url(start), stats)
+    yield page_url(start), data
+    page_count = math.ceil(data['meta']['total'] / page_size)
+    pages = iter(range(start + 1, page_count + 1))
+    futures = deque()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        try:
+            for page in islice(pages, 2 * concurrency):
+                futures.append((page, executor.submit(fetch_page_in_context, page_url(page))))
+            while futures:
+                page, future = futures.popleft()
+                data = future.result()
+                next_page = next(pages, None)
+                if next_page is not None:
+                    futures.append((next_page, executor.submit(
+                        fetch_page_in_context, page_url(next_page))))
+                yield page_url(page), data
+        finally:
+            for _, future in futures:
+                future.cancel()
+    # Rows may have been added since the pages list was planned
+    yield from iterate_on_pages(data['links'].get('next'), stats)
+
+
+class Checkpoint(object):
+    '''
+    Progress of `iterate_on_metrics` on a target, so that an interrupted
+    update-metrics job resumes from the last page written instead of the first one.
+    The position is only persisted on `commit`, once its previous rows have been written.
+    Checkpoints expire after `METRICS_CHECKPOINT_EXPIRATION` seconds.
+    '''
+
+    def __init__(self, target: str):
+        self.target = target
+        # Positions to commit by value key
+        self.positions = {}
+
+    def load(self, value_key: str) -> Optional[MetricsCheckpoint]:
+        expiration = get_config('METRICS_CHECKPOINT_EXPIRATION')
+        return MetricsCheckpoint.objects(
+            target=self.target, value_key=value_key,
+            updated_at__gte=datetime.utcnow() - timedelta(seconds=expiration)
+        ).first()
+
+    def save(self, value_key: str, url: Optional[str]) -> None:
+        MetricsCheckpoint.objects(target=self.target, value_key=value_key).update_one(
+            set__url=url, set__updated_at=datetime.utcnow(), upsert=True)
+
+    def commit(self) -> None:
+        for value_key, url in self.positions.items():
+            self.save(value_key, url)
+        self.positions = {}
+
+    @staticmethod
+    def clear() -> None:
+        MetricsCheckpoint.objects.delete()
+
+
+def iterate_on_csv(url: str, int_columns: List[str], stats: SyncStats) -> Iterator[dict]:
+    '''
+    Yield the rows of a CSV export, parsed while it is streamed.
+    Empty values are converted to `None` and `int_columns` values to integers,
+    like in the JSON API responses.
+    '''
+    with stats.timing('http_latency'):
+        response = client.get(url, stream=True)
+    stats.incr('pages_fetched')
+    with response:
+        response.encoding = 'utf-8'
+        for row in csv.DictReader(response.iter_lines(decode_unicode=True)):
+            yield {
+                key: None if value == '' else int(value) if key in int_columns else value
+                for key, value in row.items()
+            }
 
 
-def iterate_on_metrics(target: str, value_keys: List[str], page_size: int = 50) -> dict:
+def iterate_on_metrics(target: str, value_keys: List[str], page_size: int = 50,
+                       concurrency: Optional[int] = None,
+                       checkpoint: Optional[Checkpoint] = None,
+                       from_csv: Optional[bool] = None,
+                       stats: Optional[SyncStats] = None) -> dict:
     '''
     Yield all elements with not zero values for the keys inside `value_keys`.
     If you pass ['visit', 'download_resource'], it will do a `OR` and get
     metrics with one of the two values not zero.
+    The API has no `OR` filter, so each key is queried in turn (`visit__greater=1`,
+    then `download_resource__greater=1`) and the `IdBitmap` skips the rows already
+    yielded by the previous keys. They can't be excluded on the API side,
+    as a `visit__strictly_less=1` filter would also exclude the rows with a null `visit`.
+    Pages are fetched concurrently if `concurrency`
+    (defaults to `METRICS_API_CONCURRENCY`) is greater than 1.
+    If `from_csv` (defaults to `METRICS_SYNC_FROM_CSV`) is set, rows are streamed
+    from the CSV export in a single request instead of being paginated.
+    If a `checkpoint` is given, iteration resumes from its last committed position.
+    Fetching is recorded in `stats` if given.
     '''
-    yielded = set()
+    stats = stats or SyncStats(target)
+    concurrency = concurrency or get_config('METRICS_API_CONCURRENCY')
+    if from_csv is None:
+        from_csv = get_config('METRICS_SYNC_FROM_CSV')
+    yielded = IdBitmap()
 
     for value_key in value_keys:
         url = f'{current_app.config["METRICS_API"]}/{target}_total/data/'
-        url += f'?{value_key}__greater=1&page_size={page_size}'
+        filters = f'{value_key}__greater=1'
 
-        with requests.Session() as session:
-            while url is not None:
-                r = session.get(url, timeout=10)
-                r.raise_for_status()
-                data = r.json()
+        saved = checkpoint.load(value_key) if checkpoint else None
+        if saved and saved.url is None:
+            log.info(f'Skipping already processed {target} {value_key}')
+            continue
 
-                for row in data['data']:
-                    if row['__id'] not in yielded:
-                        yielded.add(row['__id'])
-                        yield row
+        if from_csv:
+            # A CSV export can't be resumed, the checkpoint only tells if it was processed
+            rows = iterate_on_csv(f'{url}csv/?{filters}', ['__id', *value_keys], stats)
+            pages = [(None, rows)]
+        else:
+            url = f'{url}?{filters}&page_size={page_size}'
+            if saved:
+                log.info(f'Resuming {target} {value_key} from {saved.url}')
+                url = saved.url
+            if concurrency > 1:
+                pages = iterate_on_pages_concurrently(url, page_size, concurrency, stats)
+            else:
+                pages = iterate_on_pages(url, stats)
+            pages = ((page_url, data['data']) for page_url, data in pages)
+
+        for page_url, rows in pages:
+            if checkpoint and page_url:
+                checkpoint.positions[value_key] = page_url
+            fetched = 0
+            for row in rows:
+                fetched += 1
+                if row['__id'] not in yielded:
+                    yielded.add(row['__id'])
+                    yield row
+            stats.incr('rows_fetched', fetched)
+
+        if checkpoint:
+            checkpoint.positions[value_key] = None
+
+
+class PipelineStop(Exception):
+    pass
+
+
+def pipelined(iterate: Callable[..., Iterator[dict]], *args,
+              checkpoint: Optional[Checkpoint] = None, **kwargs) -> Iterator[dict]:
+    '''
+    Yield the rows of `iterate(*args, **kwargs)`, run in a background thread
+    feeding a bounded queue of `METRICS_SYNC_QUEUE_SIZE` chunks of rows,
+    so that fetching the next rows overlaps with writing the previous ones.
+    The `checkpoint` positions follow the rows consumed, not the rows fetched.
+    '''
+    maxsize = get_config('METRICS_SYNC_QUEUE_SIZE')
+    if not maxsize:
+        yield from iterate(*args, checkpoint=checkpoint, **kwargs)
+        return
+
+    app = current_app._get_current_object()
+    reader = Checkpoint(checkpoint.target) if checkpoint else None
+    chunks = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> None:
+        while True:
+            if stop.is_set():
+                raise PipelineStop()
+            try:
+                return chunks.put(item, timeout=1)
+            except queue.Full:
+                continue
+
+    def produce() -> None:
+        try:
+            with app.app_context():
+                rows = iterate(*args, checkpoint=reader, **kwargs)
+                while chunk := list(islice(rows, PIPELINE_CHUNK_SIZE)):
+                    put((chunk, dict(reader.positions) if reader else None))
+            put(None)
+        except PipelineStop:
+            pass
+        except Exception as e:
+            # Re-raised by the consumer
+            try:
+                put(e)
+            except PipelineStop:
+                pass
 
-                url = data['links'].get('next')
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        while (item := chunks.get()) is not None:
+            if isinstance(item, Exception):
+                raise item
+            chunk, positions = item
+            yield from chunk
+            if checkpoint:
+                checkpoint.positions.update(positions)
+    finally:
+        stop.set()
+        producer.join()
 
 
 @log_timing
-def update_resources_and_community_resources():
-    for data in iterate_on_metrics("resources", ["download_resource"]):
-        if data['dataset_id'] is None:
-            save_model(CommunityResource, data['resource_id'], {
-                'views': data['download_resource'],
-            })
-        else:
-            Dataset.objects(resources__id=data['resource_id']).update(
-                **{f'set__resources__$__metrics__views': data['download_resource']}
-            )
+def update_resources_and_community_resources(resume: bool = False) -> Dict:
+    stats = SyncStats('resources')
+    checkpoint = Checkpoint('resources') if resume else None
+    # Resources metrics are buffered per dataset to rewrite each dataset only once
+    resources_by_dataset = defaultdict(dict)
+
+    def flush_resources(writer: BulkWriter) -> None:
+        for dataset_id, resources in resources_by_dataset.items():
+            writer.save_resources(dataset_id, resources)
+        resources_by_dataset.clear()
+
+    with BulkWriter(Dataset, stats=stats) as datasets_writer, \
+            BulkWriter(CommunityResource, stats=stats) as community_resources_writer:
+        for data in pipelined(iterate_on_metrics, "resources", ["download_resource"],
+                              checkpoint=checkpoint, stats=stats):
+            if data['dataset_id'] is None:
+                community_resources_writer.save(data['resource_id'], {
+                    'views': data['download_resource'],
+                })
+            else:
+                resources_by_dataset[data['dataset_id']][data['resource_id']] = {
+                    'views': data['download_resource'],
+                }
+                if len(resources_by_dataset) >= datasets_writer.batch_size:
+                    flush_resources(datasets_writer)
+                    # Every row read so far is written, it is safe to move the checkpoint
+                    datasets_writer.flush()
+                    community_resources_writer.flush()
+                    if checkpoint:
+                        checkpoint.commit()
+        flush_resources(datasets_writer)
+    if checkpoint:
+        checkpoint.commit()
+    return stats.as_dict()
 
 
 @log_timing
-def update_datasets():
-    for data in iterate_on_metrics("datasets", ["visit", "download_resource"]):
-        save_model(Dataset, data['dataset_id'], {
-            'views': data['visit'],
-            'resources_downloads': data['download_resource'],
-        })
+def update_datasets(resume: bool = False) -> Dict:
+    stats = SyncStats('datasets')
+    checkpoint = Checkpoint('datasets') if resume else None
+    with BulkWriter(Dataset, checkpoint=checkpoint, stats=stats) as writer:
+        for data in pipelined(iterate_on_metrics, "datasets", ["visit", "download_resource"],
+                              checkpoint=checkpoint, stats=stats):
+            writer.save(data['dataset_id'], {
+                'views': data['visit'],
+                'resources_downloads': data['download_resource'],
+            })
+    return stats.as_dict()
 
 
 @log_timing
-def update_dataservices():
-    for data in iterate_on_metrics("dataservices", ["visit"]):
-        save_model(Dataservice, data['dataservice_id'], {
-            'views': data['visit'],
-        })
+def update_dataservices(resume: bool = False) -> Dict:
+    stats = SyncStats('dataservices')
+    checkpoint = Checkpoint('dataservices') if resume else None
+    with BulkWriter(Dataservice, checkpoint=checkpoint, stats=stats) as writer:
+        for data in pipelined(iterate_on_metrics, "dataservices", ["visit"],
+                              checkpoint=checkpoint, stats=stats):
+            writer.save(data['dataservice_id'], {
+                'views': data['visit'],
+            })
+    return stats.as_dict()
 
 
 @log_timing
-def update_reuses():
-    for data in iterate_on_metrics("reuses", ["visit"]):
-        save_model(Reuse, data['reuse_id'], {
-            'views': data['visit']
-        })
+def update_reuses(resume: bool = False) -> Dict:
+    stats = SyncStats('reuses')
+    checkpoint = Checkpoint('reuses') if resume else None
+    with BulkWriter(Reuse, checkpoint=checkpoint, stats=stats) as writer:
+        for data in pipelined(iterate_on_metrics, "reuses", ["visit"],
+                              checkpoint=checkpoint, stats=stats):
+            writer.save(data['reuse_id'], {
+                'views': data['visit']
+            })
+    return stats.as_dict()
 
 
 @log_timing
-def update_organizations():
+def update_organizations(resume: bool = False) -> Dict:
+    stats = SyncStats('organizations')
+    checkpoint = Checkpoint('organizations') if resume else None
     # We're currently using visit_dataset as global metric for an orga
-    for data in iterate_on_metrics("organizations", ["visit_dataset"]):
-        save_model(Organization, data['organization_id'], {
-            'views': data['visit_dataset'],
-        })
+    with BulkWriter(Organization, checkpoint=checkpoint, stats=stats) as writer:
+        for data in pipelined(iterate_on_metrics, "organizations", ["visit_dataset"],
+                              checkpoint=checkpoint, stats=stats):
+            writer.save(data['organization_id'], {
+                'views': data['visit_dataset'],
+            })
+    return stats.as_dict()
+
+
+class SeriesWriter(object):
+    '''
+    Group the monthly metrics rows of a model by object, the rows of an object
+    being consecutive, and upsert them as one `MetricsSeries` document per object
+    in unordered `bulk_write` batches of `METRICS_BULK_BATCH_SIZE` operations.
+    Cached view metrics of the objects are invalidated after each flush,
+    as they may have been computed from their previous series
+    since the invalidation of the update steps.
+    '''
+
+    def __init__(self, model: str, metrics_labels: List[str], stats: SyncStats):
+        self.model = model
+        self.metrics_labels = metrics_labels
+        self.stats = stats
+        self.batch_size = get_config('METRICS_BULK_BATCH_SIZE')
+        self.months = get_last_13_months()
+        self.updated_at = datetime.utcnow()
+        self.object_id = None
+        self.rows = []
+        self.operations = []
+        self.cached_view_metrics = CACHED_VIEW_METRICS.get(model.capitalize())
+        self.updated_ids = []
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self, exc_type, *args):
+        self.save()
+        self.flush()
 
-def update_metrics_for_models():
+    def add(self, row: Dict) -> None:
+        object_id = row.get(f'{self.model}_id')
+        if object_id != self.object_id:
+            self.save()
+            self.object_id = object_id
+        self.rows.append(row)
+
+    def save(self) -> None:
+        if not self.rows:
+            return
+        monthly_metrics = compute_monthly_metrics(self.rows, self.metrics_labels)
+        self.operations.append(UpdateOne({'model': self.model, 'object_id': self.object_id}, {
+            '$set': {
+                'start': self.months[0],
+                'series': {label: series.array.tolist()
+                           for label, series in monthly_metrics.items()},
+                'updated_at': self.updated_at,
+            },
+        }, upsert=True))
+        self.updated_ids.append(self.object_id)
+        self.rows = []
+        if len(self.operations) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.operations:
+            return
+        operations, self.operations = self.operations, []
+        updated_ids, self.updated_ids = self.updated_ids, []
+        self.stats.incr('writes', len(operations))
+        with self.stats.timing('write_latency'):
+            result = MetricsSeries._get_collection().bulk_write(operations, ordered=False)
+        if self.cached_view_metrics:
+            invalidate(self.cached_view_metrics, updated_ids)
+        self.stats.incr('matched', result.matched_count)
+        self.stats.incr('modified', result.modified_count)
+
+
+@log_timing
+def update_monthly_series(resume: bool = False) -> Dict:
+    '''
+    Mirror the monthly metrics series of the displayed months in the `metrics_series`
+    collection, for the views not to call the metrics API.
+    Pages are fetched again on resume, the step being cheap compared to the others.
+    '''
+    stats = SyncStats('monthly')
+    if not get_config('METRICS_SYNC_MONTHLY_SERIES'):
+        return stats.as_dict()
+    page_size = 50
+    concurrency = get_config('METRICS_API_CONCURRENCY')
+    for model, labels in TRAFFIC_LABELS.items():
+        if model == 'site':
+            url = f'{current_app.config["METRICS_API"]}/site/data/'
+            params = get_monthly_params(labels)
+        else:
+            url = f'{current_app.config["METRICS_API"]}/{model}s/data/'
+            params = get_monthly_params(labels, f'{model}_id')
+            # Rows of an object are consecutive
+            del params['metric_month__sort']
+            params[f'{model}_id__sort'] = 'asc'
+        url = f'{url}?{urlencode({**params, "page_size": page_size})}'
+        if concurrency > 1:
+            pages = iterate_on_pages_concurrently(url, page_size, concurrency, stats)
+        else:
+            pages = iterate_on_pages(url, stats)
+        with SeriesWriter(model, labels, stats) as writer:
+            for _, data in pages:
+                stats.incr('rows_fetched', len(data['data']))
+                for row in data['data']:
+                    writer.add(row)
+    return stats.as_dict()
+
+
+def update_metrics_for_models(resume: bool = False) -> Dict[str, Dict]:
     log.info("Starting…")
-    update_datasets()
-    update_resources_and_community_resources()
-    update_dataservices()
-    update_reuses()
-    update_organizations()
+    summary = {name: update(resume=resume) for name, update in MODELS_UPDATES.items()}
+    if resume:
+        Checkpoint.clear()
+    invalidate_site_metrics()
+    report_summary(summary)
+    return summary
+
+
+def invalidate_site_metrics() -> None:
+    '''The site traffic metrics are updated along with the objects ones'''
+    cache.delete(cache_key('get_site_metrics'))
+
+
+def report_summary(summary: Dict[str, Dict]) -> None:
+    '''
+    Log the steps stats as a structured summary
+    and export them to `METRICS_SYNC_PROMETHEUS_FILE` if set
+    '''
+    for name, stats in summary.items():
+        log.info(f'{name}: {stats["rows_fetched"]} rows in {stats["pages_fetched"]} pages, '
+                 f'{stats["writes"]} writes ({stats["modified"]} modified, '
+                 f'{stats["skipped"]} unchanged skipped), {stats["errors"]} errors, '
+                 f'{stats["http_latency"]["sum"]:.2f}s fetching, '
+                 f'{stats["write_latency"]["sum"]:.2f}s writing')
+    log.info('update-metrics summary', extra={'summary': summary})
+    path = get_config('METRICS_SYNC_PROMETHEUS_FILE')
+    if path:
+        # Atomic write for the collector to never read a partial file
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(to_prometheus(summary))
+        os.replace(f'{path}.tmp', path)
+
+
+# Independent update steps, run in this order in sequential mode
+MODELS_UPDATES = {
+    'datasets': update_datasets,
+    'resources': update_resources_and_community_resources,
+    'dataservices': update_dataservices,
+    'reuses': update_reuses,
+    'organizations': update_organizations,
+    'monthly': update_monthly_series,
+}
+
+
+@task(route='low.metrics')
+def update_metrics_for_model(name: str) -> Dict:
+    '''Run a single update step, as part of the parallel update-metrics job'''
+    return MODELS_UPDATES[name](resume=True)
+
+
+@task(route='low.metrics')
+def summarize_update_metrics(results: List[Dict]) -> Dict[str, Dict]:
+    summary = dict(zip(MODELS_UPDATES, results))
+    # All steps succeeded, next job run starts from scratch
+    Checkpoint.clear()
+    invalidate_site_metrics()
+    report_summary(summary)
+    return summary
 
 
 @job('update-metrics', route='low.metrics')
@@ -132,4 +795,40 @@ def update_metrics(self):
     if not current_app.config['METRICS_API']:
         log.error('You need to set METRICS_API to run update-metrics')
         exit(1)
-    update_metrics_for_models()
+    if get_config('METRICS_UPDATE_PARALLEL'):
+        log.info("Starting update steps in parallel…")
+        chord(
+            update_metrics_for_model.s(name) for name in MODELS_UPDATES
+        )(summarize_update_metrics.s())
+    else:
+        update_metrics_for_models(resume=True)
+
+
+@task(route='low.metrics')
+def refresh_metrics_cache(name: str, args: List[str]) -> None:
+    '''Refresh a stale view metrics cache entry'''
+    import udata_metrics.views  # noqa: F401, register the cached view metrics functions
+    cached_functions[name].refresh(*args)
+
+
+@job('warm-metrics-cache', route='low.metrics')
+def warm_metrics_cache(self):
+    '''Precompute the site and the most visited objects view metrics'''
+    from udata_metrics.views import get_site_metrics, prefetch_metrics
+    count = get_config('METRICS_CACHE_WARM_COUNT')
+    # Stored without the lock, which may be held by a worker computing the same entry
+    get_site_metrics.store(get_site_metrics.func())
+    for model, objects in (
+        ('dataset', Dataset.objects.visible()),
+        ('reuse', Reuse.objects.visible()),
+        ('organization', Organization.objects.visible()),
+    ):
+        ids = [obj.id for obj in objects.order_by('-metrics.views').only('id').limit(count)]
+        log.info(f'Warming {len(ids)} {model}s metrics…')
+        prefetch_metrics(model, ids, refresh=True)
+
+
+@job('update-metrics-rollups', route='low.metrics')
+def update_metrics_rollups(self, full: bool = False):
+    '''Update the monthly stock metrics rollups of the current and previous month'''
+    update_rollups(full=full)
@@ -1,154 +1,296 @@
+import hashlib
+import time
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from bson import ObjectId
+from flask import Response, abort, current_app, jsonify, request, url_for
 from udata_front import theme
 from udata.app import cache
 from udata.frontend import template_hook
 from udata.harvest.models import HarvestSource
-from udata.i18n import I18nBlueprint
+from udata.i18n import I18nBlueprint, get_locale
 from udata.models import Reuse, Follow, Dataset, User, Discussion, Organization
+from udata.core.site.models import current_site
 
 
+from udata_metrics import get_config, profiling
+from udata_metrics.cache import CachedMetrics, cached_metrics
+from udata_metrics.executor import GatheredMetrics, Part, gather_metrics
 from udata_metrics.metrics import (
-    get_metrics_for_model, get_stock_metrics, get_download_url
+    DATASET_TRAFFIC_LABELS, ORGANIZATION_TRAFFIC_LABELS, REUSE_TRAFFIC_LABELS,
+    SITE_TRAFFIC_LABELS, FallbackSeries, get_metrics_for_model, get_metrics_for_models,
+    get_organization_stock_metrics, get_stock_metrics, get_download_url
 )
+from udata_metrics.rollups import get_rollup_metrics
+from udata_metrics.series import MonthSeries
+
 
+blueprint = I18nBlueprint('metrics', __name__, template_folder='templates')
 
-METRICS_CACHE_DURATION = 60 * 60  # in seconds
 
+# Live site counters displayed along the site metrics
+SITE_COUNTERS = ['datasets', 'harvesters', 'reuses', 'organizations', 'users', 'discussions']
 
-blueprint = I18nBlueprint('metrics', __name__, template_folder='templates')
+ORGANIZATION_STOCK_SERIES = ['dataset_metrics', 'reuse_metrics', 'dataset_follower_metrics',
+                             'reuse_follower_metrics', 'dataset_reuse_metrics']
 
 
-@cache.memoize(METRICS_CACHE_DURATION)
+def traffic_part(model: str, id: Optional[str], labels: List[str],
+                 traffic: Optional[List[MonthSeries]] = None) -> Part:
+    '''
+    Part computing the traffic metrics, unless already fetched,
+    degraded if they are not the metrics API ones
+    '''
+    def compute():
+        series = traffic or get_metrics_for_model(model, id, labels)
+        metrics = GatheredMetrics(zip(labels, series))
+        metrics.degraded = isinstance(series, FallbackSeries)
+        return metrics
+    return labels, compute
+
+
+def stock_parts(scope: str, id: Optional[str],
+                series: Dict[str, Callable[[], MonthSeries]]) -> List[Part]:
+    '''
+    Parts computing each stock metrics series, or reading them all from the rollups if enabled
+    '''
+    if get_config('METRICS_STOCK_ROLLUPS'):
+        return [(list(series), lambda: get_rollup_metrics(scope, id))]
+    return [
+        ([name], lambda name=name, compute=compute: {name: compute()})
+        for name, compute in series.items()
+    ]
+
+
+def compute_dataset_metrics(dataset_id: str, traffic: Optional[List[MonthSeries]] = None):
+    '''
+    Compute a dataset metrics, with its `traffic` metrics if already fetched
+    '''
+    return gather_metrics(
+        traffic_part('dataset', dataset_id, DATASET_TRAFFIC_LABELS, traffic),
+        *stock_parts('dataset', dataset_id, {
+            'reuses_metrics': lambda: get_stock_metrics(
+                Reuse.objects(datasets=dataset_id).visible()),
+            'followers_metrics': lambda: get_stock_metrics(
+                Follow.objects(following=dataset_id), date_label='since'),
+        }),
+    )
+
+
+@cached_metrics
 def get_dataset_metrics(dataset_id: str):
     '''
-    This uses @cache.memoize decorator w/ short lived cache
+    This uses @cached_metrics decorator w/ stale-while-revalidate cache
+    '''
+    return compute_dataset_metrics(dataset_id)
+
+
+def compute_reuse_metrics(reuse_id: str, traffic: Optional[List[MonthSeries]] = None):
+    '''
+    Compute a reuse metrics, with its `traffic` metrics if already fetched
     '''
-    visit, download_resource = get_metrics_for_model(
-        'dataset', dataset_id, ['visit', 'download_resource'])
-    reuses_metrics = get_stock_metrics(
-        Reuse.objects(datasets=dataset_id).visible())
-    followers_metrics = get_stock_metrics(Follow.objects(following=dataset_id),
-                                          date_label='since')
-    return {
-        'visit': visit,
-        'download_resource': download_resource,
-        'reuses_metrics': reuses_metrics,
-        'followers_metrics': followers_metrics
-    }
+    return gather_metrics(
+        traffic_part('reuse', reuse_id, REUSE_TRAFFIC_LABELS, traffic),
+        *stock_parts('reuse', reuse_id, {
+            'followers_metrics': lambda: get_stock_metrics(
+                Follow.objects(following=reuse_id), date_label='since'),
+        }),
+    )
 
 
-@cache.memoize(METRICS_CACHE_DURATION)
+@cached_metrics
 def get_reuse_metrics(reuse_id: str):
     '''
-    This uses @cache.memoize decorator w/ short lived cache
+    This uses @cached_metrics decorator w/ stale-while-revalidate cache
+    '''
+    return compute_reuse_metrics(reuse_id)
+
+
+def compute_organization_metrics(organization_id: str,
+                                 traffic: Optional[List[MonthSeries]] = None):
+    '''
+    Compute an organization metrics, with its `traffic` metrics if already fetched
     '''
-    visit, = get_metrics_for_model('reuse', reuse_id, ['visit'])
-    followers_metrics = get_stock_metrics(Follow.objects(following=reuse_id), date_label='since')
-    return {
-        'visit': visit,
-        'followers_metrics': followers_metrics
-    }
+    if get_config('METRICS_STOCK_ROLLUPS'):
+        stock_part = (ORGANIZATION_STOCK_SERIES,
+                      lambda: get_rollup_metrics('organization', organization_id))
+    else:
+        # All series are computed in a single aggregation
+        stock_part = (ORGANIZATION_STOCK_SERIES,
+                      lambda: get_organization_stock_metrics(organization_id))
+    return gather_metrics(
+        traffic_part('organization', organization_id, ORGANIZATION_TRAFFIC_LABELS, traffic),
+        stock_part,
+    )
 
 
-@cache.memoize(METRICS_CACHE_DURATION)
+@cached_metrics
 def get_organization_metrics(organization_id: str):
     '''
-    This uses @cache.memoize decorator w/ short lived cache
-    '''
-    visit_dataset, download_resource, visit_reuse = get_metrics_for_model(
-        'organization', organization_id, ['visit_dataset', 'download_resource', 'visit_reuse'])
-    dataset_metrics = get_stock_metrics(
-        Dataset.objects(organization=organization_id).visible(),
-        date_label='created_at_internal')
-    reuse_metrics = get_stock_metrics(Reuse.objects(organization=organization_id).visible())
-
-    dataset_follower_metrics = get_stock_metrics(
-        Follow.objects(following__in=Dataset.objects(organization=organization_id)),
-        date_label='since')
-    reuse_follower_metrics = get_stock_metrics(
-        Follow.objects(following__in=Reuse.objects(organization=organization_id)),
-        date_label='since')
-    dataset_reuse_metrics = get_stock_metrics(
-        Reuse.objects(datasets__in=Dataset.objects(organization=organization_id)).visible())
-    return {
-        'visit_dataset': visit_dataset,
-        'download_resource': download_resource,
-        'visit_reuse': visit_reuse,
-        'dataset_metrics': dataset_metrics,
-        'reuse_metrics': reuse_metrics,
-        'dataset_follower_metrics': dataset_follower_metrics,
-        'reuse_follower_metrics': reuse_follower_metrics,
-        'dataset_reuse_metrics': dataset_reuse_metrics
-    }
-
-
-@cache.memoize(METRICS_CACHE_DURATION)
+    This uses @cached_metrics decorator w/ stale-while-revalidate cache
+    '''
+    return compute_organization_metrics(organization_id)
+
+
+@cached_metrics
 def get_site_metrics():
     '''
-    This uses @cache.memoize decorator w/ short lived cache
-    '''
-    visit_dataset, download_resource = get_metrics_for_model(
-        'site', None, ['visit_dataset', 'download_resource'])
-    user_metrics = get_stock_metrics(User.objects())
-    dataset_metrics = get_stock_metrics(Dataset.objects().visible(),
-                                        date_label='created_at_internal')
-    harvest_metrics = get_stock_metrics(HarvestSource.objects())
-    reuse_metrics = get_stock_metrics(Reuse.objects().visible())
-    organization_metrics = get_stock_metrics(Organization.objects().visible())
-    discussion_metrics = get_stock_metrics(Discussion.objects(), date_label='created')
-    return {
-        'visit_dataset': visit_dataset,
-        'download_resource': download_resource,
-        'user_metrics': user_metrics,
-        'dataset_metrics': dataset_metrics,
-        'harvest_metrics': harvest_metrics,
-        'reuse_metrics': reuse_metrics,
-        'organization_metrics': organization_metrics,
-        'discussion_metrics': discussion_metrics,
-        'visit_dataset': visit_dataset
-    }
+    This uses @cached_metrics decorator w/ stale-while-revalidate cache
+    '''
+    return gather_metrics(
+        traffic_part('site', None, SITE_TRAFFIC_LABELS),
+        *stock_parts('site', None, {
+            'user_metrics': lambda: get_stock_metrics(User.objects()),
+            'dataset_metrics': lambda: get_stock_metrics(
+                Dataset.objects().visible(), date_label='created_at_internal'),
+            'harvest_metrics': lambda: get_stock_metrics(HarvestSource.objects()),
+            'reuse_metrics': lambda: get_stock_metrics(Reuse.objects().visible()),
+            'organization_metrics': lambda: get_stock_metrics(Organization.objects().visible()),
+            'discussion_metrics': lambda: get_stock_metrics(
+                Discussion.objects(), date_label='created'),
+        }),
+    )
+
+
+# Cached view metrics getter, compute function and traffic labels by model
+VIEW_METRICS = {
+    'dataset': (get_dataset_metrics, compute_dataset_metrics, DATASET_TRAFFIC_LABELS),
+    'reuse': (get_reuse_metrics, compute_reuse_metrics, REUSE_TRAFFIC_LABELS),
+    'organization': (get_organization_metrics, compute_organization_metrics,
+                     ORGANIZATION_TRAFFIC_LABELS),
+}
+
+
+def prefetch_metrics(model: str, ids: List[Union[str, ObjectId]], refresh: bool = False) -> None:
+    '''
+    Populate the cached view metrics of several objects of a model,
+    fetching the traffic metrics of the uncached ones (or all of them on `refresh`) in batch.
+    '''
+    getter, compute, labels = VIEW_METRICS[model]
+    if refresh:
+        missing = ids
+    else:
+        keys = [getter.cache_key(id) for id in ids]
+        missing = [id for id, entry in zip(ids, cache.get_many(*keys)) if entry is None]
+    if not missing:
+        return
+    traffic = get_metrics_for_models(model, missing, labels)
+    for id in missing:
+        getter.store(compute(id, traffic=traffic[str(id)]), id)
+
+
+def get_metrics_url(model: str, id: Optional[ObjectId]) -> str:
+    if id:
+        return url_for('metrics.model_metrics_json', model=model, id=id)
+    return url_for('metrics.site_metrics_json')
+
+
+def metrics_response(getter: CachedMetrics, *args) -> Response:
+    '''
+    JSON response of cached metrics, with an ETag of their version
+    and cacheable until they are stale
+    '''
+    fresh_until, metrics = getter.lookup(*args)
+    if fresh_until is None:
+        response = jsonify(metrics)
+        response.add_etag()
+        max_age = 0
+    else:
+        etag = hashlib.sha1(f'{getter.cache_key(*args)}:{fresh_until}'.encode()).hexdigest()
+        # Metrics are not even serialized if the client has their version
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = jsonify(metrics)
+        response.set_etag(etag)
+        max_age = max(0, int(fresh_until - time.time()))
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    return response.make_conditional(request)
+
+
+@blueprint.route('/metrics/site')
+def site_metrics_json():
+    return metrics_response(get_site_metrics)
+
+
+@blueprint.route('/metrics/<any(dataset,reuse,organization):model>/<id>')
+def model_metrics_json(model: str, id: str):
+    getter, _, _ = VIEW_METRICS[model]
+    document = {'dataset': Dataset, 'reuse': Reuse, 'organization': Organization}[model]
+    if not ObjectId.is_valid(id) or document.objects(id=id).visible().only('id').first() is None:
+        abort(404)
+    return metrics_response(getter, ObjectId(id))
+
+
+def render_metrics(template: str, getter: CachedMetrics, model: str,
+                   id: Optional[ObjectId], counters: Tuple, **context) -> str:
+    '''
+    Render a metrics template with the cached metrics of an object, or of the site.
+    The fragment is cached by locale and theme along with the metrics version
+    and the live `counters` displayed by the template,
+    until the metrics are refreshed in a new version.
+    With `METRICS_HOOKS_PLACEHOLDER`, uncached metrics are computed in background
+    and a placeholder linking to their JSON endpoint is rendered meanwhile.
+    '''
+    args = (id,) if id else ()
+    if get_config('METRICS_HOOKS_PLACEHOLDER'):
+        entry = getter.peek(*args)
+        if entry is None:
+            if getter.acquire(*args):
+                getter.refresh_in_background(*args)
+            return theme.render('metrics-placeholder.html',
+                                metrics_url=get_metrics_url(model, id))
+        fresh_until, metrics = entry
+    else:
+        fresh_until, metrics = getter.lookup(*args)
+    key = ':'.join([getter.cache_key(*args), 'html', str(get_locale()),
+                    current_app.config['THEME'], str(fresh_until),
+                    *(str(counter) for counter in counters)])
+    if fresh_until is not None:
+        html = cache.get(key)
+        if html is not None:
+            profiling.record('metrics-fragment', f'{template} hit')
+            return html
+    profiling.record('metrics-fragment', f'{template} miss')
+    with profiling.timing('metrics-render', template):
+        html = theme.render(template, metric_csv_url=get_download_url(model, id),
+                            **context, **metrics)
+    if fresh_until is not None:
+        # Stale metrics are served until their refresh in a new version is stored
+        timeout = max(0, int(fresh_until - time.time())) + get_config('METRICS_CACHE_LOCK_TIMEOUT')
+        cache.set(key, html, timeout=timeout)
+    return html
+
+
+blueprint.before_app_request(profiling.start_request)
+blueprint.after_app_request(profiling.report)
 
 
 @template_hook('dataset.display.metrics')
 def dataset_metrics(ctx):
     dataset = ctx['dataset']
-    dataset_metrics = get_dataset_metrics(dataset.id)
-    metric_csv_url = get_download_url('dataset', dataset.id)
-    return theme.render('dataset-metrics.html',
-                        dataset=dataset,
-                        metric_csv_url=metric_csv_url,
-                        **dataset_metrics
-                        )
+    return render_metrics('dataset-metrics.html', get_dataset_metrics, 'dataset', dataset.id,
+                          (dataset.metrics.get('reuses'), dataset.metrics.get('followers')),
+                          dataset=dataset)
 
 
 @template_hook('reuse.display.metrics')
 def reuse_metrics(ctx):
     reuse = ctx['reuse']
-    reuse_metrics = get_reuse_metrics(reuse.id)
-    metric_csv_url = get_download_url('reuse', reuse.id)
-    return theme.render('reuse-metrics.html',
-                        reuse=reuse,
-                        metric_csv_url=metric_csv_url,
-                        **reuse_metrics
-                        )
+    return render_metrics('reuse-metrics.html', get_reuse_metrics, 'reuse', reuse.id,
+                          (reuse.metrics.get('followers'),), reuse=reuse)
 
 
 @template_hook('organization.display.metrics')
 def organization_metrics(ctx):
     org = ctx['org']
-    organization_metrics = get_organization_metrics(org.id)
-    metric_csv_url = get_download_url('organization', org.id)
-    return theme.render('organization-metrics.html',
-                        org=org,
-                        metric_csv_url=metric_csv_url,
-                        **organization_metrics
-                        )
+    return render_metrics('organization-metrics.html', get_organization_metrics, 'organization',
+                          org.id, (org.metrics.get('datasets'), org.metrics.get('reuses')),
+                          org=org)
 
 
 @template_hook('site.display.metrics')
 def site_metrics(ctx):
-    site_metrics = get_site_metrics()
-    metric_csv_url = get_download_url('site', None)
-    return theme.render('site-metrics.html',
-                        metric_csv_url=metric_csv_url,
-                        **site_metrics
-                        )
+    return render_metrics('site-metrics.html', get_site_metrics, 'site', None, tuple(
+        current_site.metrics.get(counter) for counter in SITE_COUNTERS))